@@ -0,0 +1,290 @@
+"""Headless benchmarks for file_history.py.
+
+Runs the plugin against the stub `sublime` and `sublime_plugin` modules in `stubs/`
+on synthetic histories and prints the timings as JSON:
+
+    python3 benchmarks/run_benchmarks.py --sizes 100 1000 10000 100000 --output results.json
+
+Every benchmark reports the time of a whole repetition (min/median/max in seconds)
+and the time per operation in microseconds (based on the fastest repetition).
+"""
+import argparse
+import contextlib
+import json
+import os
+import platform
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCHMARK_DIR, 'stubs'))
+sys.path.insert(0, os.path.dirname(BENCHMARK_DIR))
+
+import sublime  # noqa: E402 (the stub)
+import file_history  # noqa: E402
+from file_history import FileHistory, OpenRecentlyClosedFileCommand  # noqa: E402
+
+# Share of the synthetic files that don't exist (and are removed by the cleanup)
+MISSING_RATIO = 0.1
+# Number of entries per synthetic project
+PROJECT_SIZE = 100
+# Number of tab events timed by the add_view benchmark
+ADD_VIEW_EVENTS = 1000
+# Number of file names checked by the path exclusion benchmarks
+EXCLUSION_SAMPLE = 1000
+# Groups and tabs per group of the window used by the open view lookup benchmark
+LOOKUP_GROUPS = 4
+LOOKUP_TABS = 40
+# Seconds a stat on the simulated hung mount blocks (the worker threads are daemons)
+HUNG_STAT_DURATION = 3600
+# Queries of the search_history benchmarks
+SEARCH_QUERIES = ['module', 'module_0123', 'd042 module_00', 'files/d00', 'py']
+
+
+class Fixture(object):
+    """A synthetic history of `size` global entries spread over projects, with the files on disk"""
+
+    def __init__(self, root, size):
+        self.root = root
+        self.size = size
+        self.files = []
+        self.projects = []
+        file_dir = os.path.join(root, 'files')
+        for i in range(size):
+            directory = os.path.join(file_dir, 'd%03d' % (i % 100))
+            filename = os.path.join(directory, 'module_%06d.py' % i)
+            self.files.append(filename)
+            if i % int(1 / MISSING_RATIO) == 0:
+                continue
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            open(filename, 'w').close()
+
+        for i in range(max(1, size // PROJECT_SIZE)):
+            project_file = os.path.join(root, 'project_%04d.sublime-project' % i)
+            open(project_file, 'w').close()
+            self.projects.append(project_file)
+
+        now = int(time.time())
+        history = {FileHistory.SCHEMA_VERSION_KEY: FileHistory.SCHEMA_VERSION}
+        history['global'] = self.__split(self.files, now)
+        for i, project_file in enumerate(self.projects):
+            history[project_file] = self.__split(self.files[i * PROJECT_SIZE:(i + 1) * PROJECT_SIZE], now)
+        self.history_data = json.dumps(history)
+
+    @staticmethod
+    def __split(files, now):
+        """The first half is closed, the second half opened; older entries come later"""
+        entries = [dict(filename=filename, group=0, index=i % 20, timestamp=now - i * 60)
+                   for i, filename in enumerate(files)]
+        half = len(entries) // 2
+        return {'closed': entries[:half], 'opened': entries[half:]}
+
+
+def measure(name, size, func, ops=1, setup=None, repeat=5):
+    """Time `func` (excluding `setup`) `repeat` times. Every call performs `ops` operations"""
+    timings = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - start)
+        # Run the flushes etc. that were scheduled, outside of the measurement
+        sublime.run_timeouts()
+
+    return dict(name=name, entries=size, ops=ops, repeat=repeat,
+                min=min(timings), median=statistics.median(timings), max=max(timings),
+                per_op_us=min(timings) / ops * 1e6)
+
+
+def run_size(size, args):
+    root = tempfile.mkdtemp(prefix='file-history-bench-')
+    try:
+        fixture = Fixture(root, size)
+        history_file = os.path.join(root, 'FileHistory.json')
+        with open(history_file, 'w') as f:
+            f.write(fixture.history_data)
+
+        window = sublime.add_window(sublime.Window(folders=[root], project_file_name=fixture.projects[0]))
+
+        patterns = ['.*/generated_%d/.*' % i for i in range(args.patterns)]
+        patterns.append(r'.*\.(min\.js|lock|pyc)$')
+        FileHistory().app_settings.update({
+            'history_file': history_file,
+            'global_max_entries': size,
+            'project_max_entries': PROJECT_SIZE,
+            'cleanup_on_startup': False,
+            'save_delay': 0,
+            'max_backup_count': 0,
+            'path_exclude_patterns': patterns,
+            'path_reinclude_patterns': ['.*/generated_0/keep/.*'],
+        })
+        history = FileHistory()
+
+        def load():
+            history._FileHistory__load_history()
+
+        def rewrite_and_load():
+            with open(history_file, 'w') as f:
+                f.write(fixture.history_data)
+            load()
+
+        results = []
+        repeat = args.repeat
+
+        results.append(measure('load', size, load, repeat=repeat))
+
+        def save():
+            history._FileHistory__save_history()
+            history.flush_history()
+        results.append(measure('save', size, save, repeat=repeat))
+
+        results.append(measure('get_history (project)', size, lambda: history.get_history(True), repeat=repeat))
+        results.append(measure('get_history (global)', size, lambda: history.get_history(False), repeat=repeat))
+
+        # Reopen recently used files, which moves them to the front of the histories
+        existing = [filename for filename in fixture.files[:PROJECT_SIZE * 2] if os.path.exists(filename)]
+        views = [window.open_file(filename) for filename in existing]
+
+        def add_views():
+            for i in range(ADD_VIEW_EVENTS):
+                history.add_view(window, views[i % len(views)], 'opened')
+            # Rapid events are collected as a burst, include adding them to the history
+            history.flush_view_events()
+        results.append(measure('add_view', size, add_views, ops=ADD_VIEW_EVENTS, repeat=repeat))
+
+        def add_views_separately():
+            burst_interval = history.BURST_INTERVAL
+            history.BURST_INTERVAL = 0
+            try:
+                add_views()
+            finally:
+                history.BURST_INTERVAL = burst_interval
+        results.append(measure('add_view (no bursts)', size, add_views_separately, ops=ADD_VIEW_EVENTS,
+                               repeat=repeat))
+        for view in views:
+            window.close_view(view)
+
+        def clear_matchers():
+            history._FileHistory__path_matchers = {}
+
+        sample = fixture.files[:EXCLUSION_SAMPLE]
+        is_excluded = history._FileHistory__is_excluded
+
+        def exclusion_sample():
+            # Like a tab event: the matcher is looked up when the view is captured, then the file is checked
+            view = sublime.View(window)
+            for filename in sample:
+                is_excluded(history.get_path_matcher(view.settings().get('file_history', dict())), filename)
+        results.append(measure('path exclusion (cold)', size, exclusion_sample, ops=len(sample),
+                               setup=clear_matchers, repeat=repeat))
+        results.append(measure('path exclusion (warm)', size, exclusion_sample, ops=len(sample), repeat=repeat))
+
+        command = OpenRecentlyClosedFileCommand(window)
+
+        def clear_display_cache():
+            OpenRecentlyClosedFileCommand._OpenRecentlyClosedFileCommand__display_cache.clear()
+
+        def show_panel():
+            command.run(current_project_only=False)
+            command.open_file(-1)
+        results.append(measure('show panel (cold)', size, show_panel, setup=clear_display_cache, repeat=repeat))
+        results.append(measure('show panel (warm)', size, show_panel, repeat=repeat))
+
+        # "Is this file already open in another group", as checked for every highlight in the panel
+        lookup_window = sublime.Window(folders=[root], num_groups=LOOKUP_GROUPS)
+        for group in range(LOOKUP_GROUPS):
+            lookup_window.focus_group(group)
+            for filename in fixture.files[group * LOOKUP_TABS:(group + 1) * LOOKUP_TABS]:
+                lookup_window.open_file(filename)
+        lookup_window.focus_group(0)
+        lookup_sample = fixture.files[:LOOKUP_GROUPS * LOOKUP_TABS * 2]
+
+        def find_open_views():
+            for filename in lookup_sample:
+                history.get_view_from_another_group(lookup_window, filename)
+        results.append(measure('get_view_from_another_group', size, find_open_views, ops=len(lookup_sample),
+                               repeat=repeat))
+
+        # Simulate a hung network mount holding every tenth directory of the files
+        stat_cache = history.stat_cache
+        hung_mount = os.path.join(root, 'files', 'hung')
+
+        def on_hung_mount(path):
+            return os.path.basename(os.path.dirname(path)).endswith('0')
+
+        def hung_stat(path):
+            if on_hung_mount(path):
+                time.sleep(HUNG_STAT_DURATION)
+            return os.stat(path)
+
+        def clear_caches():
+            clear_display_cache()
+            stat_cache.clear()
+
+        mount_point = stat_cache.mount_point
+        stat_cache.stat_function = hung_stat
+        stat_cache.mount_point = lambda path: hung_mount if on_hung_mount(path) else mount_point(path)
+        try:
+            results.append(measure('show panel (hung mount)', size, show_panel, setup=clear_caches, repeat=repeat))
+        finally:
+            stat_cache.stat_function = os.stat
+            del stat_cache.mount_point
+
+        def clear_search_index():
+            history._FileHistory__path_index = None
+
+        def search():
+            for query in SEARCH_QUERIES:
+                history.search_history(query, 500)
+        results.append(measure('search_history (cold)', size, search, ops=len(SEARCH_QUERIES),
+                               setup=clear_search_index, repeat=repeat))
+        results.append(measure('search_history (warm)', size, search, ops=len(SEARCH_QUERIES), repeat=repeat))
+
+        results.append(measure('clean_history', size, lambda: history.clean_history(False),
+                               setup=rewrite_and_load, repeat=repeat))
+
+        sublime.run_timeouts()
+        return results
+    finally:
+        sublime._windows[:] = []
+        shutil.rmtree(root, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=[100, 1000, 10000, 100000],
+                        help='numbers of entries in the global history')
+    parser.add_argument('--repeat', type=int, default=5, help='repetitions of every benchmark')
+    parser.add_argument('--patterns', type=int, default=200, help='number of path exclusion patterns')
+    parser.add_argument('--output', help='write the JSON results to this file instead of stdout')
+    args = parser.parse_args()
+
+    packages_path = tempfile.mkdtemp(prefix='sublime-packages-')
+    sublime.set_packages_path(packages_path)
+    try:
+        results = []
+        # Keep the plugin's console output out of the JSON
+        with contextlib.redirect_stdout(sys.stderr):
+            for size in args.sizes:
+                print('Benchmarking %d entries...' % size)
+                results.extend(run_size(size, args))
+    finally:
+        shutil.rmtree(packages_path, ignore_errors=True)
+
+    report = dict(python=platform.python_version(), platform=platform.platform(),
+                  plugin=os.path.abspath(file_history.__file__), results=results)
+    data = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(data + '\n')
+    else:
+        print(data)
+
+
+if __name__ == '__main__':
+    main()
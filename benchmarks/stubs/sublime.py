@@ -0,0 +1,216 @@
+"""Minimal stand-in for Sublime Text's `sublime` module.
+
+Only implements what file_history.py uses, so the plugin can be benchmarked headless.
+Timeouts are queued instead of run and have to be processed with `run_timeouts`.
+"""
+import tempfile
+
+TRANSIENT = 4
+FORCE_GROUP = 8
+MONOSPACE_FONT = 1
+OP_EQUAL = 0
+OP_NOT_EQUAL = 1
+
+_packages_path = tempfile.mkdtemp(prefix='sublime-packages-')
+_settings = {}
+_timeouts = []
+_windows = []
+
+
+def packages_path():
+    return _packages_path
+
+
+def set_packages_path(path):
+    global _packages_path
+    _packages_path = path
+
+
+class Settings(object):
+    def __init__(self, values=None):
+        self._values = dict(values or {})
+        self._callbacks = {}
+
+    def has(self, key):
+        return key in self._values
+
+    def get(self, key, default=None):
+        return self._values.get(key, default)
+
+    def set(self, key, value):
+        self._values[key] = value
+        for callback in list(self._callbacks.values()):
+            callback()
+
+    def update(self, values):
+        """Not part of the API: set multiple values, notifying listeners once"""
+        self._values.update(values)
+        for callback in list(self._callbacks.values()):
+            callback()
+
+    def add_on_change(self, key, callback):
+        self._callbacks[key] = callback
+
+    def clear_on_change(self, key):
+        self._callbacks.pop(key, None)
+
+
+def load_settings(name):
+    return _settings.setdefault(name, Settings())
+
+
+def set_timeout(callback, delay=0):
+    _timeouts.append(callback)
+
+
+def set_timeout_async(callback, delay=0):
+    _timeouts.append(callback)
+
+
+def run_timeouts():
+    """Not part of the API: run all queued timeouts (including ones queued meanwhile)"""
+    while _timeouts:
+        _timeouts.pop(0)()
+
+
+def error_message(message):
+    print('error: ' + message)
+
+
+def status_message(message):
+    pass
+
+
+class View(object):
+    _next_id = 1
+
+    def __init__(self, window, filename=None, group=0):
+        self._id = View._next_id
+        View._next_id += 1
+        self._window = window
+        self._filename = filename
+        self._group = group
+        self._settings = Settings()
+
+    def id(self):
+        return self._id
+
+    def file_name(self):
+        return self._filename
+
+    def settings(self):
+        return self._settings
+
+    def window(self):
+        return self._window
+
+    def size(self):
+        return 0
+
+    def run_command(self, command, args=None):
+        pass
+
+    def __eq__(self, other):
+        return isinstance(other, View) and other._id == self._id
+
+    def __hash__(self):
+        return self._id
+
+
+class Window(object):
+    _next_id = 1
+
+    def __init__(self, folders=(), project_file_name=None, num_groups=1):
+        self._id = Window._next_id
+        Window._next_id += 1
+        self._folders = list(folders)
+        self._project_file_name = project_file_name
+        self._num_groups = num_groups
+        self._views = []
+        self._active_group = 0
+        self.quick_panel_items = None
+
+    def id(self):
+        return self._id
+
+    def folders(self):
+        return self._folders
+
+    def project_file_name(self):
+        return self._project_file_name
+
+    def num_groups(self):
+        return self._num_groups
+
+    def active_group(self):
+        return self._active_group
+
+    def focus_group(self, group):
+        self._active_group = group
+
+    def views(self):
+        return list(self._views)
+
+    def views_in_group(self, group):
+        return [view for view in self._views if view._group == group]
+
+    def active_view(self):
+        views = self.views_in_group(self._active_group)
+        return views[-1] if views else None
+
+    def get_view_index(self, view):
+        if view not in self._views:
+            return (-1, -1)
+        return (view._group, self.views_in_group(view._group).index(view))
+
+    def set_view_index(self, view, group, index):
+        view._group = group
+
+    def transient_view_in_group(self, group):
+        return None
+
+    def open_file(self, filename, flags=0):
+        view = View(self, filename, self._active_group)
+        self._views.append(view)
+        return view
+
+    def find_open_file(self, filename):
+        for view in self._views:
+            if view._filename == filename:
+                return view
+        return None
+
+    def close_view(self, view):
+        """Not part of the API: remove a view from the window"""
+        self._views.remove(view)
+
+    def focus_view(self, view):
+        self._active_group = view._group
+
+    def run_command(self, command, args=None):
+        pass
+
+    def create_output_panel(self, name):
+        return View(self)
+
+    def show_input_panel(self, caption, initial_text, on_done, on_change, on_cancel):
+        return View(self)
+
+    def show_quick_panel(self, items, on_select, flags=0, selected_index=-1, on_highlight=None):
+        self.quick_panel_items = items
+
+
+def windows():
+    return list(_windows)
+
+
+def active_window():
+    if not _windows:
+        _windows.append(Window())
+    return _windows[0]
+
+
+def add_window(window):
+    """Not part of the API: register a window and make it the active one"""
+    _windows.insert(0, window)
+    return window
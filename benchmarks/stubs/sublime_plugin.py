@@ -0,0 +1,20 @@
+"""Minimal stand-in for Sublime Text's `sublime_plugin` module."""
+
+
+class EventListener(object):
+    pass
+
+
+class ViewEventListener(object):
+    def __init__(self, view):
+        self.view = view
+
+
+class WindowCommand(object):
+    def __init__(self, window):
+        self.window = window
+
+
+class TextCommand(object):
+    def __init__(self, view):
+        self.view = view
@@ -1,12 +1,38 @@
 import os
+import sys
+import errno
 import hashlib
 import json
 import time
 import re
 import shutil
 import glob
+import gzip
+import threading
+import queue
+import itertools
+import math
+import bisect
+import heapq
+from collections import OrderedDict, deque
 from textwrap import dedent
 
+try:
+    import sqlite3
+except ImportError:
+    # Not available in Sublime Text's Python on every platform
+    sqlite3 = None
+
+# Advisory file locking is done with fcntl on POSIX and msvcrt on Windows
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+try:
+    import msvcrt
+except ImportError:
+    msvcrt = None
+
 import sublime
 import sublime_plugin
 
@@ -21,6 +47,1447 @@ class Singleton(type):
         return cls._instance
 
 
+class HistoryEntry(object):
+    """A single history entry.
+
+    The same files are usually tracked in several projects, so entries use `__slots__`
+    and share a single interned string per filename.
+    Supports read access like the dicts stored in the history file.
+    """
+
+    __slots__ = ('filename', 'group', 'index', 'timestamp', 'count', 'score')
+
+    # The frecency score halves every week the file isn't opened
+    FRECENCY_HALF_LIFE = 7 * 24 * 3600
+    DECAY_RATE = math.log(2) / FRECENCY_HALF_LIFE
+
+    def __init__(self, filename, group=-1, index=-1, timestamp=None, count=1, score=1.0):
+        self.filename = sys.intern(filename)
+        self.group = group
+        self.index = index
+        self.timestamp = timestamp
+        # Number of times the file was opened and the frecency score as of `timestamp`
+        self.count = count
+        self.score = score
+
+    @classmethod
+    def coerce(cls, entry):
+        """Convert an entry from the history file to a HistoryEntry (if it isn't one already)"""
+        if isinstance(entry, cls):
+            return entry
+        return cls(entry['filename'], entry.get('group', -1), entry.get('index', -1), entry.get('timestamp'),
+                   entry.get('count', 1), entry.get('score', 1.0))
+
+    def decayed_score(self, timestamp):
+        """Return the frecency score as of timestamp"""
+        elapsed = max(0, timestamp - (self.timestamp or timestamp))
+        return self.score * math.exp(-self.DECAY_RATE * elapsed)
+
+    def rank(self):
+        """Return a key that orders entries by their current frecency score.
+
+        The log of the decayed score is `log(score) - DECAY_RATE * (now - timestamp)`,
+        so the order doesn't depend on the current time and never has to be recomputed.
+        """
+        return math.log(max(self.score, sys.float_info.min)) + self.DECAY_RATE * (self.timestamp or 0)
+
+    def to_dict(self):
+        entry = {'filename': self.filename, 'group': self.group, 'index': self.index}
+        if self.timestamp is not None:
+            entry['timestamp'] = self.timestamp
+        if self.count != 1:
+            entry['count'] = self.count
+        if self.score != 1.0:
+            entry['score'] = self.score
+        return entry
+
+    def __contains__(self, key):
+        return key in self.__slots__ and getattr(self, key) is not None
+
+    def __getitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def get(self, key, default=None):
+        return self[key] if key in self else default
+
+    def __repr__(self):
+        return 'HistoryEntry(%r)' % self.to_dict()
+
+
+class HistoryList(object):
+    """Recency-ordered history entries (most recent first), indexed by filename.
+
+    Inserting at the front, removing, membership tests and evicting the oldest entry
+    are all constant-time operations.
+    `version` changes with every modification and is unique across all lists.
+
+    Once the entries are requested by frecency (with `ranked` or `truncate`),
+    a sorted list of their ranks is maintained as well, with binary searches on every change.
+    """
+
+    _version_counter = itertools.count(1)
+
+    def __init__(self, entries=()):
+        self.__entries = OrderedDict()
+        # Sorted (rank, filename) pairs, see `ranked`
+        self.__ranking = None
+        # Ranked flag -> (version, tuple of the entries), see `snapshot`
+        self.__snapshots = {}
+        self.version = next(self._version_counter)
+        # Keep the most recent entry if there are duplicates
+        for entry in reversed(entries):
+            self.add(entry)
+
+    def __len__(self):
+        return len(self.__entries)
+
+    def __iter__(self):
+        return iter(self.__entries.values())
+
+    def __contains__(self, filename):
+        return filename in self.__entries
+
+    def get(self, filename):
+        return self.__entries.get(filename)
+
+    def add(self, entry):
+        """Insert an entry at the front, replacing any entry with the same filename"""
+        entry = HistoryEntry.coerce(entry)
+        filename = entry.filename
+        self.__replaced(self.__entries.get(filename), entry)
+        self.__entries[filename] = entry
+        self.__entries.move_to_end(filename, last=False)
+        self.version = next(self._version_counter)
+
+    def remove(self, filename):
+        """Remove the entry for filename and return it (or None)"""
+        entry = self.__entries.pop(filename, None)
+        if entry is not None:
+            self.__replaced(entry, None)
+            self.version = next(self._version_counter)
+        return entry
+
+    def __replaced(self, old_entry, new_entry):
+        """Keep the ranking up to date (if it is maintained)"""
+        if self.__ranking is None:
+            return
+        if old_entry is not None:
+            del self.__ranking[bisect.bisect_left(self.__ranking, (old_entry.rank(), old_entry.filename))]
+        if new_entry is not None:
+            bisect.insort(self.__ranking, (new_entry.rank(), new_entry.filename))
+
+    def __get_ranking(self):
+        if self.__ranking is None:
+            self.__ranking = sorted((entry.rank(), entry.filename) for entry in self.__entries.values())
+        return self.__ranking
+
+    def ranked(self):
+        """Return the entries by frecency, highest first"""
+        return [self.__entries[filename] for (_, filename) in reversed(self.__get_ranking())]
+
+    def insert(self, entry):
+        """Insert an entry behind all entries with a newer timestamp (and in front of those with the same one),
+        replacing any entry with the same filename"""
+        entry = HistoryEntry.coerce(entry)
+        filename = entry.filename
+        timestamp = entry.timestamp or 0
+        self.__replaced(self.__entries.pop(filename, None), entry)
+        self.__entries[filename] = entry
+        # Move the older entries behind it (usually there are few, as merged entries tend to be recent)
+        older = []
+        for other in reversed(self.__entries):
+            if other == filename:
+                continue
+            if (self.__entries[other].timestamp or 0) > timestamp:
+                break
+            older.append(other)
+        for other in reversed(older):
+            self.__entries.move_to_end(other)
+        self.version = next(self._version_counter)
+
+    def truncate(self, max_entries, ranked=False):
+        """Evict entries so that at most max_entries remain and return them.
+
+        Evicts the oldest entries or, if ranked, those with the lowest frecency (except the most recent one).
+        """
+        evicted = []
+        if ranked and max_entries > 0 and len(self.__entries) > max_entries:
+            ranking = self.__get_ranking()
+            newest = next(iter(self.__entries))
+            position = 0
+            while len(self.__entries) > max_entries:
+                filename = ranking[position][1]
+                if filename == newest:
+                    position += 1
+                    continue
+                del ranking[position]
+                evicted.append(self.__entries.pop(filename))
+        else:
+            while len(self.__entries) > max(max_entries, 0):
+                entry = self.__entries.popitem(last=True)[1]
+                self.__replaced(entry, None)
+                evicted.append(entry)
+        if evicted:
+            self.version = next(self._version_counter)
+        return evicted
+
+    def to_list(self):
+        return list(self.__entries.values())
+
+    def snapshot(self, ranked=False):
+        """Return the entries (by frecency if ranked) as a tuple, which is shared until the list changes"""
+        cached = self.__snapshots.get(ranked)
+        if cached is None or cached[0] != self.version:
+            entries = self.ranked() if ranked else self.__entries.values()
+            cached = self.__snapshots[ranked] = (self.version, tuple(entries))
+        return cached[1]
+
+
+class HistorySnapshot(object):
+    """An immutable copy of the history of a project, shared by all readers until the history changes.
+
+    `entries` holds the closed files followed by the opened files, so panel rows map directly to their entries.
+    Supports `snapshot['opened']` etc. like the dict `get_history` used to return.
+    """
+
+    __slots__ = ('closed', 'opened', 'entries', 'version')
+
+    def __init__(self, closed=(), opened=(), version=None):
+        self.closed = closed
+        self.opened = opened
+        self.entries = closed + opened
+        self.version = version
+
+    def __getitem__(self, key):
+        if key not in self.__slots__:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def get(self, key, default=None):
+        return getattr(self, key) if key in self.__slots__ else default
+
+
+class PathIndex(object):
+    """Index of file paths for searching them by the segments of the path.
+
+    Paths are split into lowercase tokens (at path separators, dots, dashes, underscores and spaces).
+    A query matches every path that has a token starting with each of the query's tokens;
+    the matching paths are found with prefix lookups in the sorted tokens, without scanning all paths.
+    Paths are reference counted, as the same file usually is in multiple history lists.
+    """
+
+    TOKEN_SEPARATORS = re.compile(r'[\\/._\-\s]+')
+
+    def __init__(self):
+        # filename -> number of references, newest timestamp
+        self.__references = {}
+        self.__timestamps = {}
+        # Filenames from the least to the most recently used (sorted again when `__sorted_by_recency` is reset)
+        self.__by_recency = OrderedDict()
+        self.__sorted_by_recency = True
+        self.__newest = 0
+        # token -> set of filenames (separately for the tokens of the base names)
+        self.__postings = {}
+        self.__basename_postings = {}
+        # Sorted on the first search, then kept sorted
+        self.__sorted_tokens = None
+
+    def __len__(self):
+        return len(self.__references)
+
+    @classmethod
+    def tokenize(cls, text):
+        return [token for token in cls.TOKEN_SEPARATORS.split(text.lower()) if token]
+
+    def add(self, filename, timestamp=None):
+        timestamp = timestamp or 0
+        if filename in self.__references:
+            self.__references[filename] += 1
+            if timestamp > self.__timestamps[filename]:
+                self.__timestamps[filename] = timestamp
+                self.__touch(filename, timestamp)
+            return
+
+        self.__references[filename] = 1
+        self.__timestamps[filename] = timestamp
+        self.__by_recency[filename] = None
+        self.__touch(filename, timestamp)
+        for token in set(self.tokenize(filename)):
+            postings = self.__postings.get(token)
+            if postings is None:
+                postings = self.__postings[token] = set()
+                if self.__sorted_tokens is not None:
+                    bisect.insort(self.__sorted_tokens, token)
+            postings.add(filename)
+        for token in set(self.tokenize(os.path.basename(filename))):
+            self.__basename_postings.setdefault(token, set()).add(filename)
+
+    def remove(self, filename):
+        references = self.__references.get(filename)
+        if references is None:
+            return
+        if references > 1:
+            self.__references[filename] = references - 1
+            return
+
+        del self.__references[filename]
+        del self.__timestamps[filename]
+        del self.__by_recency[filename]
+        for token in set(self.tokenize(filename)):
+            postings = self.__postings[token]
+            postings.discard(filename)
+            if not postings:
+                del self.__postings[token]
+                if self.__sorted_tokens is not None:
+                    del self.__sorted_tokens[bisect.bisect_left(self.__sorted_tokens, token)]
+        for token in set(self.tokenize(os.path.basename(filename))):
+            postings = self.__basename_postings[token]
+            postings.discard(filename)
+            if not postings:
+                del self.__basename_postings[token]
+
+    def __touch(self, filename, timestamp):
+        """Keep __by_recency in order (usually the file is the most recent one)"""
+        if timestamp >= self.__newest:
+            self.__newest = timestamp
+            self.__by_recency.move_to_end(filename)
+        else:
+            self.__sorted_by_recency = False
+
+    def __most_recent(self, paths, limit, exclude=frozenset()):
+        """Return the up to limit most recently used paths that are not excluded"""
+        if len(paths) * 16 < len(self.__references):
+            # Sorting few paths is cheaper than looking for them
+            if exclude:
+                paths = paths - exclude
+            return heapq.nlargest(limit, paths, key=self.__timestamps.__getitem__)
+
+        if not self.__sorted_by_recency:
+            self.__by_recency = OrderedDict.fromkeys(sorted(self.__timestamps, key=self.__timestamps.__getitem__))
+            self.__sorted_by_recency = True
+        # Many paths match, so there will be enough of them among the most recent ones
+        results = []
+        for filename in reversed(self.__by_recency):
+            if filename in paths and filename not in exclude:
+                results.append(filename)
+                if len(results) == limit:
+                    break
+        return results
+
+    def __matching(self, prefix, postings):
+        """Return the paths with a token in postings that starts with prefix"""
+        if self.__sorted_tokens is None:
+            self.__sorted_tokens = sorted(self.__postings)
+        tokens = self.__sorted_tokens
+        start = end = bisect.bisect_left(tokens, prefix)
+        while end < len(tokens) and tokens[end].startswith(prefix):
+            end += 1
+        if end - start == 1:
+            # The caller doesn't modify the result, so there is no need to copy a single posting
+            return postings.get(tokens[start], frozenset())
+        matches = set()
+        for token in tokens[start:end]:
+            matches.update(postings.get(token, ()))
+        return matches
+
+    def search(self, query, limit):
+        """Return up to limit paths matching query.
+
+        Paths matching the whole query in their base name come first, then the most recently used ones.
+        """
+        terms = sorted(set(self.tokenize(query)), key=len, reverse=True)
+        if not terms:
+            return []
+
+        # Longer terms tend to match fewer paths, which keeps the intersections small
+        candidates = None
+        for term in terms:
+            matches = self.__matching(term, self.__postings)
+            candidates = matches if candidates is None else candidates & matches
+            if not candidates:
+                return []
+
+        best = candidates
+        for term in terms:
+            best = best & self.__matching(term, self.__basename_postings)
+
+        results = self.__most_recent(best, limit)
+        if len(results) < limit:
+            results += self.__most_recent(candidates, limit - len(results), exclude=best)
+        return results
+
+
+class PathMatcher(object):
+    """Pre-compiled exclude and re-include patterns with a bounded memo of results"""
+
+    MEMO_SIZE = 1024
+
+    def __init__(self, exclude_patterns, reinclude_patterns):
+        self.exclude_patterns = exclude_patterns
+        self.reinclude_patterns = reinclude_patterns
+        self.__exclude = self.__compile(exclude_patterns)
+        self.__reinclude = self.__compile(reinclude_patterns)
+        self.__memo = OrderedDict()
+        # is_excluded runs on the UI thread and on the async thread (for bursts of tab events)
+        self.__memo_lock = threading.Lock()
+
+    @staticmethod
+    def __compile(patterns):
+        """Combine the patterns into as few regular expressions as possible"""
+        simple = []
+        simple_compiled = []
+        compiled = []
+        for pattern in patterns:
+            try:
+                regex = re.compile(pattern)
+            except re.error as e:
+                print('[FileHistory] Ignoring invalid path pattern "%s": %s' % (pattern, e))
+                continue
+            # Patterns with groups can't be combined safely (backreferences, duplicate names),
+            # neither can patterns with global inline flags like "(?i)" (which would apply to all of them)
+            if regex.groups or regex.flags & ~re.UNICODE:
+                compiled.append(regex)
+            else:
+                simple.append(pattern)
+                simple_compiled.append(regex)
+
+        if len(simple) > 1:
+            try:
+                simple_compiled = [re.compile('|'.join('(?:%s)' % pattern for pattern in simple))]
+            except re.error as e:
+                print('[FileHistory] Could not combine the path patterns: %s' % e)
+        return simple_compiled + compiled
+
+    @staticmethod
+    def __search(regexes, filename):
+        return any(regex.search(filename) for regex in regexes)
+
+    def is_excluded(self, filename):
+        """Check whether the filename is excluded and not re-included"""
+        with self.__memo_lock:
+            result = self.__memo.get(filename)
+            if result is not None:
+                self.__memo.move_to_end(filename)
+                return result
+
+        # Force forward slashes in the filename
+        normalized = os.path.normpath(filename).replace("\\", "/")
+        result = (self.__search(self.__exclude, normalized)
+                  and not self.__search(self.__reinclude, normalized))
+
+        with self.__memo_lock:
+            self.__memo[filename] = result
+            if len(self.__memo) > self.MEMO_SIZE:
+                self.__memo.popitem(last=False)
+        return result
+
+    def explain(self, filename):
+        """Return the first exclude and re-include pattern matching filename (for debugging)"""
+        normalized = os.path.normpath(filename).replace("\\", "/")
+
+        def first_match(patterns):
+            for pattern in patterns:
+                try:
+                    if re.search(pattern, normalized):
+                        return pattern
+                except re.error:
+                    pass
+
+        return normalized, first_match(self.exclude_patterns), first_match(self.reinclude_patterns)
+
+
+class RealPathCache(object):
+    """Bounded memo of `os.path.realpath` (see the `real_path` setting).
+
+    A resolved path is reused while the filename still leads to the same file:
+    a single stat (resolved by the OS in one go) replaces the lstat of every path component,
+    and a symlink along the path that now points elsewhere invalidates the entry.
+    The stat goes through `stat_cache` (a StatCache), so files on unavailable mounts are left unresolved.
+    """
+
+    MEMO_SIZE = 4096
+
+    def __init__(self, stat_cache=None):
+        self.stat_cache = stat_cache
+        self.__lock = threading.Lock()
+        # Filename -> (resolved path, (device, inode) of the file it was resolved to)
+        self.__memo = OrderedDict()
+
+    def resolve(self, filename):
+        result = self.stat_cache.stat(filename)
+        if result is StatCache.UNAVAILABLE:
+            # Resolving it would block on the mount
+            return filename
+        if result is None:
+            # Nothing to validate against (e.g. the file was deleted)
+            with self.__lock:
+                self.__memo.pop(filename, None)
+            return os.path.realpath(filename)
+        identity = (result.st_dev, result.st_ino)
+        if not result.st_ino:
+            # No inode numbers on this platform
+            return os.path.realpath(filename)
+
+        with self.__lock:
+            cached = self.__memo.get(filename)
+            if cached is not None and cached[1] == identity:
+                self.__memo.move_to_end(filename)
+                return cached[0]
+
+        realname = os.path.realpath(filename)
+        with self.__lock:
+            self.__memo[filename] = (realname, identity)
+            self.__memo.move_to_end(filename)
+            if len(self.__memo) > self.MEMO_SIZE:
+                self.__memo.popitem(last=False)
+        return realname
+
+    def clear(self):
+        with self.__lock:
+            self.__memo.clear()
+
+
+class OpenViewIndex(object):
+    """The open views of every window by file name, kept up to date by the view events.
+
+    A window is scanned the first time it is looked up (e.g. for the views restored with the session).
+    Views are verified when they are looked up, so a missed event can't return a view that moved or closed.
+    """
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        # Window id -> file name -> views
+        self.__windows = {}
+        # Normalizes the file names of the views (e.g. resolves symlinks for the `real_path` setting)
+        self.__key = None
+
+    def set_key(self, key):
+        """Index the views by key(file name) from now on"""
+        with self.__lock:
+            self.__key = key
+            self.__windows = {}
+
+    def __filename(self, view):
+        filename = view.file_name()
+        if filename is None or self.__key is None:
+            return filename
+        return self.__key(filename)
+
+    def add(self, view):
+        """Index a view that was loaded, cloned, saved under another name or moved"""
+        window = view.window()
+        filename = self.__filename(view)
+        if window is None or filename is None:
+            return
+        with self.__lock:
+            files = self.__windows.get(window.id())
+            # Windows that weren't looked up yet are scanned completely later
+            if files is not None:
+                views = files.setdefault(filename, [])
+                if view not in views:
+                    views.append(view)
+
+    def remove(self, view):
+        filename = self.__filename(view)
+        with self.__lock:
+            for files in self.__windows.values():
+                views = files.get(filename)
+                if views and view in views:
+                    views.remove(view)
+                    if not views:
+                        del files[filename]
+
+    def discard_window(self, window):
+        with self.__lock:
+            self.__windows.pop(window.id(), None)
+
+    def find(self, window, filename):
+        """Return the views of the file that are open in the window"""
+        with self.__lock:
+            files = self.__windows.get(window.id())
+            if files is None:
+                files = self.__windows[window.id()] = {}
+                for view in window.views():
+                    view_filename = self.__filename(view)
+                    if view_filename is not None:
+                        files.setdefault(view_filename, []).append(view)
+
+            views = files.get(filename)
+            if not views:
+                return []
+            valid = [view for view in views if self.__is_open(view, window, filename)]
+            if len(valid) < len(views):
+                if valid:
+                    files[filename] = valid
+                else:
+                    del files[filename]
+            return valid
+
+    def __is_open(self, view, window, filename):
+        view_window = view.window()
+        return view_window is not None and view_window.id() == window.id() and self.__filename(view) == filename
+
+
+class _StatRequest(object):
+    """Paths on one mount that a StatCache worker stats for a waiting caller"""
+
+    __slots__ = ('mount', 'paths', 'results', 'done', 'started', 'progress', 'abandoned', 'stuck', 'replaced')
+
+    def __init__(self, mount, paths):
+        self.mount = mount
+        self.paths = paths
+        self.results = {}
+        self.done = threading.Event()
+        self.started = False
+        # When the request was submitted or its latest stat finished
+        self.progress = time.perf_counter()
+        self.abandoned = False
+        # Whether a stat of the request timed out and whether another worker was started in place of its worker
+        self.stuck = False
+        self.replaced = False
+
+
+class StatCache(object):
+    """Size-bounded cache of `os.stat` results that expire after `ttl` seconds.
+
+    The stats run on worker threads and a caller stops waiting once a stat takes more than `timeout` seconds
+    (or no worker makes progress for that long), so a hung network mount can't block it.
+    A mount on which a stat timed out or whose stats take more than half the timeout on average
+    is considered unavailable for `backoff` seconds (and as long as a stat on it is stuck):
+    its paths are reported as UNAVAILABLE instead of being checked.
+    The root mount is never considered unavailable as a whole, only the directories in which a stat was that slow.
+    """
+
+    MAX_SIZE = 10000
+    # Paths stat'ed by a worker in one go
+    CHUNK_SIZE = 128
+    # Seconds after which an idle worker exits
+    WORKER_IDLE_TIMEOUT = 30
+    # Weight of the latest stat in the average latency of a mount
+    LATENCY_WEIGHT = 0.2
+
+    # Returned by `stat` for paths on unavailable mounts
+    UNAVAILABLE = 'unavailable'
+    # Never considered unavailable: everything depends on it,
+    # and the files on mounts that aren't in the mount table (yet) are attributed to it
+    ROOT_MOUNT = '/'
+    # Seconds after which the mount table is read again (to notice the mounts added since)
+    MOUNT_TABLE_TTL = 60
+
+    def __init__(self, ttl, timeout=0.5, backoff=60, max_workers=8, max_size=MAX_SIZE):
+        self.ttl = ttl
+        # Should hold every file in the history, so a panel doesn't evict the files it just checked
+        self.max_size = max(max_size, self.MAX_SIZE)
+        self.timeout = timeout
+        self.backoff = backoff
+        # Workers stuck on hung mounts never return, so at most this many are started (further stats are queued)
+        self.max_workers = max(1, max_workers)
+        # Workers stuck on the root mount that are replaced (it can't be backed off as a whole)
+        self.max_root_stuck = max(1, self.max_workers // 2)
+        # Does the actual stats (can be replaced to simulate a slow file system)
+        self.stat_function = os.stat
+        self.__lock = threading.Lock()
+        self.__cache = OrderedDict()
+        self.__requests = queue.Queue()
+        self.__workers = 0
+        self.__idle_workers = 0
+        # Stuck workers that weren't replaced (see `max_root_stuck`)
+        self.__blocked_workers = 0
+        # When a worker last started a request or finished a stat (or a stuck one was replaced)
+        self.__progress = 0
+        # Mount point -> dict(latency=average seconds or None, until=unavailable until,
+        #                    stuck=number of stats that timed out, running=requests in progress)
+        self.__mounts = {}
+        # Directory on the root mount -> unavailable until
+        self.__directories = {}
+        # Sorted mount points (longest first) and the mount points of recently checked directories
+        self.__mount_points = None
+        self.__mount_points_expire = 0
+        self.__mounts_by_dir = {}
+
+    def stat(self, path, refresh=False):
+        """Return the stat result for path, None if it doesn't exist or UNAVAILABLE if its mount isn't responding"""
+        if not refresh:
+            with self.__lock:
+                cached = self.__cache.get(path)
+            if cached is not None and cached[0] > time.time():
+                return cached[1]
+
+        # Even a mount that responded quickly so far might hang, so the stat always runs on a worker
+        return self.stat_many((path,), refresh)[path]
+
+    def stat_many(self, paths, refresh=False, timeout=None):
+        """Return a dict of path -> result of `stat`, checking the paths that aren't cached on parallel workers.
+
+        Waits as long as the workers make progress. The paths on mounts (or root directories) that stalled
+        or were backed off are UNAVAILABLE, as are the paths that weren't checked within `timeout` seconds (if given).
+        """
+        deadline = float('inf') if timeout is None else time.perf_counter() + timeout
+        now = time.time()
+        results = {}
+        requests = []
+        with self.__lock:
+            self.__mark_stalled()
+            pending = OrderedDict()
+            for path in paths:
+                if not refresh:
+                    cached = self.__cache.get(path)
+                    if cached is not None and cached[0] > now:
+                        results[path] = cached[1]
+                        continue
+                mount = self.mount_point(path)
+                if self.__is_unavailable(mount, now, path) or self.__blocked_workers >= self.max_workers:
+                    # Nothing could check it before the deadline
+                    results[path] = self.UNAVAILABLE
+                else:
+                    pending.setdefault(mount, []).append(path)
+
+            for (mount, mount_paths) in pending.items():
+                for i in range(0, len(mount_paths), self.CHUNK_SIZE):
+                    request = _StatRequest(mount, mount_paths[i:i + self.CHUNK_SIZE])
+                    requests.append(request)
+                    self.__requests.put(request)
+            self.__start_workers()
+
+        for request in requests:
+            while not request.done.wait(max(0, min(deadline, self.__last_progress(request) + self.timeout)
+                                            - time.perf_counter())):
+                with self.__lock:
+                    now = time.perf_counter()
+                    if request.done.is_set():
+                        break
+                    if request.started and now - request.progress > self.timeout:
+                        self.__mark_stuck(request)
+                    elif not request.started and now - self.__last_progress(request) > self.timeout:
+                        # The workers might be stuck on other requests, replace them
+                        self.__mark_stalled()
+                        if now - self.__last_progress(request) <= self.timeout:
+                            continue
+                    elif now < deadline:
+                        continue
+                    # The worker stops before its next stat
+                    request.abandoned = True
+                    break
+            for path in request.paths:
+                results[path] = request.results.get(path, self.UNAVAILABLE)
+        return results
+
+    def __last_progress(self, request):
+        """Return when the request (or while it is queued, any worker) last made progress"""
+        return request.progress if request.started else max(request.progress, self.__progress)
+
+    def __start_workers(self):
+        """Start workers for the queued requests (workers stuck on a hung mount don't count)"""
+        while self.__idle_workers < self.__requests.qsize() and self.__workers < self.max_workers:
+            self.__workers += 1
+            self.__idle_workers += 1
+            threading.Thread(target=self.__work, name='FileHistory stat worker', daemon=True).start()
+
+    def __work(self):
+        while True:
+            try:
+                request = self.__requests.get(timeout=self.WORKER_IDLE_TIMEOUT)
+            except queue.Empty:
+                with self.__lock:
+                    if self.__requests.empty():
+                        self.__workers -= 1
+                        self.__idle_workers -= 1
+                        return
+                continue
+
+            with self.__lock:
+                self.__progress = time.perf_counter()
+                if request.abandoned:
+                    continue
+                self.__mark_stalled()
+                state = self.__mount_state(request.mount)
+                if self.__is_unavailable(request.mount, time.time()):
+                    # Don't get stuck on a mount that isn't responding, the results are UNAVAILABLE
+                    request.done.set()
+                    continue
+                self.__idle_workers -= 1
+                request.started = True
+                request.progress = self.__progress
+                state['running'].add(request)
+
+            # The lock is only taken for slow stats, so the workers don't contend for it on a fast file system
+            quick = []
+            for path in request.paths:
+                # Reading the flags without the lock is fine, a request or mount never becomes available again
+                if request.abandoned or self.__is_unavailable(request.mount, time.time(), path):
+                    # The mount (or directory) was backed off meanwhile, the remaining paths are UNAVAILABLE
+                    break
+                start = time.perf_counter()
+                try:
+                    result = self.stat_function(path)
+                except (OSError, ValueError):
+                    result = None
+                end = time.perf_counter()
+                (request.results[path], request.progress, self.__progress) = (result, end, end)
+                if end - start > self.timeout / 2:
+                    with self.__lock:
+                        # Back off a slow mount while the request is still running
+                        self.__update_latency(request.mount, path, end - start)
+                else:
+                    quick.append(end - start)
+
+            with self.__lock:
+                self.__store(request.results)
+                if quick:
+                    # Can't exceed the limit, so the mount isn't backed off
+                    self.__update_latency(request.mount, request.paths[0], sum(quick) / len(quick))
+
+            with self.__lock:
+                request.done.set()
+                state['running'].discard(request)
+                self.__idle_workers += 1
+                if request.stuck:
+                    # A stat that timed out finally returned, the worker is available again
+                    state['stuck'] -= 1
+                    if request.replaced:
+                        self.__workers += 1
+                    else:
+                        self.__blocked_workers -= 1
+
+    def __mark_stalled(self):
+        """Mark the running requests whose current stat timed out as stuck (their callers might have given up before)"""
+        now = time.perf_counter()
+        for state in self.__mounts.values():
+            for request in list(state['running']):
+                if now - request.progress > self.timeout:
+                    self.__mark_stuck(request)
+
+    def __mark_stuck(self, request):
+        """Give up on a request whose current stat timed out (must be called with the lock held)"""
+        if request.stuck:
+            return
+        state = self.__mounts[request.mount]
+        request.stuck = request.abandoned = True
+        request.done.set()
+        state['stuck'] += 1
+        # Other requests don't have to wait for it (it is counted as stuck until it returns)
+        state['running'].discard(request)
+        self.__back_off([next((path for path in request.paths if path not in request.results), request.paths[-1])])
+        # Replace the stuck worker, but don't pile up stuck workers on the root mount
+        if request.mount != self.ROOT_MOUNT or state['stuck'] <= self.max_root_stuck:
+            request.replaced = True
+            self.__workers -= 1
+            self.__start_workers()
+            # Give the replacement a chance
+            self.__progress = time.perf_counter()
+        else:
+            self.__blocked_workers += 1
+
+    def __mount_state(self, mount):
+        """Return the state of a mount, see `__mounts` (must be called with the lock held)"""
+        state = self.__mounts.get(mount)
+        if state is None:
+            state = self.__mounts[mount] = dict(latency=None, until=0, stuck=0, running=set())
+        return state
+
+    def __is_unavailable(self, mount, now, path=None):
+        """Return whether the mount (or for the root mount, the directory of path) is backed off"""
+        if mount == self.ROOT_MOUNT:
+            return path is not None and self.__directories.get(os.path.dirname(path), 0) > now
+        state = self.__mount_state(mount)
+        return state['until'] > now or state['stuck'] > 0
+
+    def __back_off(self, paths):
+        """Consider the mounts of the paths (on the root mount, their directories) unavailable for `backoff` seconds"""
+        # The paths might be on a mount that was added since the mount table was read
+        self.__mount_points = None
+        self.__mounts_by_dir = {}
+        now = time.time()
+        until = now + self.backoff
+        for path in paths:
+            mount = self.mount_point(path)
+            if mount != self.ROOT_MOUNT:
+                if self.__mount_state(mount)['until'] <= now:
+                    print('[FileHistory] Checking the files on %s takes more than %.1fs, ignoring them for %ds'
+                          % (mount, self.timeout, self.backoff))
+                self.__mount_state(mount)['until'] = until
+                continue
+            directory = os.path.dirname(path)
+            if self.__directories.get(directory, 0) <= now:
+                print('[FileHistory] Checking the files in %s takes more than %.1fs, ignoring them for %ds'
+                      % (directory, self.timeout, self.backoff))
+            if len(self.__directories) >= self.MAX_SIZE:
+                self.__directories = {directory: expires for (directory, expires) in self.__directories.items()
+                                      if expires > now}
+            self.__directories[directory] = until
+
+    def __store(self, results):
+        """Cache the results of stats (must be called with the lock held)"""
+        expires = time.time() + self.ttl
+        for (path, result) in results.items():
+            self.__cache[path] = (expires, result)
+            self.__cache.move_to_end(path)
+        while len(self.__cache) > self.max_size:
+            self.__cache.popitem(last=False)
+
+    def __update_latency(self, mount, path, latency):
+        """Update the average latency of a mount with a stat of path that took `latency` seconds"""
+        state = self.__mounts[mount]
+        if state['latency'] is None:
+            state['latency'] = latency
+        else:
+            state['latency'] += self.LATENCY_WEIGHT * (latency - state['latency'])
+        if latency > self.timeout or state['latency'] > self.timeout / 2:
+            # Start over once the mount is checked again
+            state['latency'] = None
+            self.__back_off([path])
+
+    def mount_point(self, path):
+        """Return the mount point (or drive) of a path, without touching the file system"""
+        if os.name == 'nt':
+            return os.path.splitdrive(path)[0].lower()
+
+        directory = os.path.dirname(path)
+        mount = self.__mounts_by_dir.get(directory)
+        if mount is None:
+            if self.__mount_points is None or time.time() > self.__mount_points_expire:
+                self.__mount_points = self.__read_mount_points()
+                self.__mount_points_expire = time.time() + self.MOUNT_TABLE_TTL
+                self.__mounts_by_dir = {}
+            mount = next((mount_point for mount_point in self.__mount_points
+                          if directory == mount_point or directory.startswith(mount_point.rstrip('/') + '/')),
+                         self.ROOT_MOUNT)
+            if mount == self.ROOT_MOUNT and directory.startswith('/Volumes/'):
+                # No mount table on macOS, but that is where volumes are mounted
+                mount = '/'.join(directory.split('/')[:3])
+            if len(self.__mounts_by_dir) >= self.MAX_SIZE:
+                self.__mounts_by_dir.clear()
+            self.__mounts_by_dir[directory] = mount
+        return mount
+
+    @staticmethod
+    def __read_mount_points():
+        """Return the mount points listed in /proc/mounts (Linux), longest first"""
+        try:
+            with open('/proc/mounts', 'rb') as f:
+                lines = f.read().decode('utf-8', 'replace').splitlines()
+        except OSError:
+            return []
+        # Spaces etc. are escaped as octal numbers
+        unescape = re.compile(r'\\([0-7]{3})')
+        mount_points = [unescape.sub(lambda m: chr(int(m.group(1), 8)), line.split()[1])
+                        for line in lines if len(line.split()) > 1]
+        return sorted(set(mount_points), key=len, reverse=True)
+
+    def exists(self, path, refresh=False):
+        """Return whether path exists (files on unavailable mounts are assumed to exist)"""
+        return self.stat(path, refresh) is not None
+
+    def is_unavailable(self, path):
+        return self.stat(path) is self.UNAVAILABLE
+
+    def getmtime(self, path):
+        """Return the modification time of path or None if it doesn't exist or is unavailable"""
+        result = self.stat(path)
+        return result.st_mtime if result is not None and result is not self.UNAVAILABLE else None
+
+    def clear(self):
+        with self.__lock:
+            self.__cache.clear()
+
+
+class FileLock(object):
+    """Advisory lock on a file that is shared between processes (and Sublime Text instances).
+
+    Use as a context manager. If the file can't be locked, a warning is printed and the block runs anyway
+    (`locked` tells whether it is). With a timeout (in seconds), locking is retried until it expires instead of blocking.
+    """
+
+    RETRY_INTERVAL = 0.02
+
+    def __init__(self, path, timeout=None):
+        self.path = path
+        self.timeout = timeout
+        self.file = None
+        self.locked = False
+
+    def __enter__(self):
+        try:
+            self.file = open(self.path, 'a+b')
+            if self.timeout is None:
+                self.__lock(blocking=True)
+            else:
+                deadline = time.time() + self.timeout
+                while not self.__lock(blocking=False):
+                    if time.time() >= deadline:
+                        raise OSError('timed out after %.1fs' % self.timeout)
+                    time.sleep(self.RETRY_INTERVAL)
+            self.locked = True
+        except (OSError, IOError) as e:
+            print('[FileHistory] Could not lock "%s": %s: %s' % (self.path, e.__class__.__name__, e))
+        return self
+
+    def __lock(self, blocking):
+        """Return whether the file was locked (only False if not blocking and another process holds the lock)"""
+        if fcntl is not None:
+            try:
+                fcntl.flock(self.file.fileno(), fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except (OSError, IOError) as e:
+                if blocking or e.errno not in (errno.EAGAIN, errno.EACCES):
+                    raise
+                return False
+        elif msvcrt is not None:
+            # Lock the first byte; LK_LOCK retries for 10 seconds before giving up
+            self.file.seek(0)
+            try:
+                msvcrt.locking(self.file.fileno(), msvcrt.LK_LOCK if blocking else msvcrt.LK_NBLCK, 1)
+            except (OSError, IOError):
+                if blocking:
+                    raise
+                return False
+        return True
+
+    def __exit__(self, *exc_info):
+        if self.file is None:
+            return False
+        try:
+            if fcntl is not None:
+                fcntl.flock(self.file.fileno(), fcntl.LOCK_UN)
+            elif msvcrt is not None:
+                self.file.seek(0)
+                msvcrt.locking(self.file.fileno(), msvcrt.LK_UNLCK, 1)
+        except (OSError, IOError):
+            pass
+        finally:
+            self.file.close()
+            self.file = None
+            self.locked = False
+        return False
+
+
+class _NullLock(object):
+    """Stands in for a FileLock while file locking is disabled (nothing is locked)"""
+
+    locked = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+class _NullContext(object):
+    """Context manager that does nothing (used while the stats are disabled)"""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+class _Timer(object):
+    def __init__(self, stats, name):
+        self.stats = stats
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stats.record(self.name, time.perf_counter() - self.start)
+        return False
+
+
+class PerfStats(object):
+    """Durations of the plugin's operations and the number of bytes they wrote.
+
+    Nothing is recorded unless `enabled` is set; until then, `timed` returns a shared no-op context manager.
+    Percentiles are computed from the last MAX_SAMPLES durations of every operation.
+    """
+
+    MAX_SAMPLES = 1000
+    NULL_TIMER = _NullContext()
+
+    def __init__(self):
+        self.enabled = False
+        self.__lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.__lock:
+            self.__started = time.time()
+            # name -> [count, total, max, recent durations]
+            self.__timings = {}
+            self.__bytes_written = {}
+
+    def timed(self, name):
+        """Return a context manager that records the duration of its block as operation `name`"""
+        if not self.enabled:
+            return self.NULL_TIMER
+        return _Timer(self, name)
+
+    def record(self, name, duration):
+        with self.__lock:
+            timing = self.__timings.get(name)
+            if timing is None:
+                timing = self.__timings[name] = [0, 0.0, 0.0, deque(maxlen=self.MAX_SAMPLES)]
+            timing[0] += 1
+            timing[1] += duration
+            timing[2] = max(timing[2], duration)
+            timing[3].append(duration)
+
+    def add_bytes_written(self, name, count):
+        if not self.enabled:
+            return
+        with self.__lock:
+            self.__bytes_written[name] = self.__bytes_written.get(name, 0) + count
+
+    @staticmethod
+    def __percentile(samples, percent):
+        return samples[min(len(samples) - 1, int(len(samples) * percent / 100))]
+
+    def report(self):
+        """Return the stats as a table"""
+        with self.__lock:
+            timings = sorted((name, list(timing[:3]) + [sorted(timing[3])]) for name, timing in self.__timings.items())
+            bytes_written = sorted(self.__bytes_written.items())
+            started = self.__started
+
+        lines = ['Collected for %d seconds' % (time.time() - started), '']
+        lines.append('%-28s %8s %10s %10s %10s %10s' % ('operation', 'count', 'total ms', 'p50 ms', 'p95 ms', 'max ms'))
+        for (name, (count, total, maximum, samples)) in timings:
+            lines.append('%-28s %8d %10.1f %10.2f %10.2f %10.2f'
+                         % (name, count, total * 1000, self.__percentile(samples, 50) * 1000,
+                            self.__percentile(samples, 95) * 1000, maximum * 1000))
+        if bytes_written:
+            lines.append('')
+            lines.append('%-28s %19s' % ('file', 'bytes written'))
+            for (name, count) in bytes_written:
+                lines.append('%-28s %19d' % (name, count))
+        return '\n'.join(lines)
+
+
+class SqliteHistoryStorage(object):
+    """Stores the history in an SQLite database with one indexed row per entry.
+
+    Changes are applied with the same records that are written to the journal,
+    so adding or removing an entry only touches the affected rows.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS projects (
+            id INTEGER PRIMARY KEY,
+            key TEXT NOT NULL UNIQUE
+        );
+        CREATE TABLE IF NOT EXISTS entries (
+            project_id INTEGER NOT NULL,
+            filename TEXT NOT NULL,
+            type TEXT NOT NULL,
+            "group" INTEGER,
+            "index" INTEGER,
+            timestamp INTEGER,
+            seq INTEGER NOT NULL,
+            count INTEGER NOT NULL DEFAULT 1,
+            score REAL NOT NULL DEFAULT 1.0,
+            rank REAL NOT NULL DEFAULT 0.0,
+            PRIMARY KEY (project_id, filename)
+        );
+        CREATE INDEX IF NOT EXISTS entries_by_recency ON entries (project_id, type, seq);
+    """
+
+    # Columns added after the first version of SCHEMA
+    ADDED_COLUMNS = (
+        ('count', 'INTEGER NOT NULL DEFAULT 1'),
+        ('score', 'REAL NOT NULL DEFAULT 1.0'),
+        ('rank', 'REAL NOT NULL DEFAULT 0.0'),
+    )
+
+    # Indexes on the ADDED_COLUMNS, created once the columns exist
+    ADDED_INDEXES = """
+        CREATE INDEX IF NOT EXISTS entries_by_rank ON entries (project_id, type, rank, filename);
+    """
+
+    def __init__(self, path, max_entries, ranked):
+        self.path = path
+        # Callable returning the maximum number of entries for a project key
+        self.max_entries = max_entries
+        # Callable returning whether to evict the entries with the lowest frecency instead of the oldest
+        self.ranked = ranked
+        self.__lock = threading.Lock()
+        self.__connection = None
+        self.__project_ids = {}
+        # Insertion counter, defines the order of the entries
+        self.__seq = 0
+
+    def __connect(self):
+        if self.__connection is None:
+            connection = sqlite3.connect(self.path, check_same_thread=False)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            connection.executescript(self.SCHEMA)
+            columns = {row[1] for row in connection.execute('PRAGMA table_info(entries)')}
+            for (column, definition) in self.ADDED_COLUMNS:
+                if column not in columns:
+                    connection.execute('ALTER TABLE entries ADD COLUMN %s %s' % (column, definition))
+            if 'rank' not in columns:
+                # Existing entries have the default score (whose log is 0)
+                with connection:
+                    connection.execute('UPDATE entries SET rank = ? * COALESCE(timestamp, 0)',
+                                       (HistoryEntry.DECAY_RATE,))
+            # For evicting the lowest ranked entries without sorting the whole project
+            connection.executescript(self.ADDED_INDEXES)
+            self.__seq = connection.execute('SELECT COALESCE(MAX(seq), 0) FROM entries').fetchone()[0]
+            self.__connection = connection
+        return self.__connection
+
+    def exists(self):
+        return os.path.exists(self.path)
+
+    def close(self):
+        with self.__lock:
+            if self.__connection is not None:
+                self.__connection.close()
+                self.__connection = None
+                self.__project_ids = {}
+
+    def project_keys(self):
+        with self.__lock:
+            return [row[0] for row in self.__connect().execute('SELECT key FROM projects')]
+
+    def load_project(self, project_key):
+        """Return the 'opened' and 'closed' HistoryLists of a single project"""
+        with self.__lock:
+            rows = self.__connect().execute(
+                'SELECT e.filename, e.type, e."group", e."index", e.timestamp, e.count, e.score'
+                ' FROM entries e JOIN projects p ON p.id = e.project_id'
+                ' WHERE p.key = ? ORDER BY e.seq DESC', (project_key,)
+            ).fetchall()
+
+        project = {'opened': [], 'closed': []}
+        for (filename, history_type, group, index, timestamp, count, score) in rows:
+            project[history_type].append(HistoryEntry(filename, group, index, timestamp, count, score))
+        return {key: HistoryList(entries) for (key, entries) in project.items()}
+
+    def changes(self, records, history):
+        """Return what `apply` needs to persist the records (called while the history is locked)"""
+        return records
+
+    def import_history(self, history):
+        """Replace the contents of the database with history (e.g. loaded from the JSON file)"""
+        records = [{'op': 'reset'}]
+        for (project_key, project) in history.items():
+            for history_type in ('opened', 'closed'):
+                # Insert the oldest entries first
+                for entry in reversed(project[history_type].to_list()):
+                    records.append({'op': 'add', 'project': project_key, 'type': history_type, 'entry': entry})
+        self.apply(records, truncate=False)
+
+    def apply(self, records, truncate=True):
+        """Apply the journal records in a single transaction (nothing is applied if it fails)"""
+        with self.__lock:
+            connection = self.__connect()
+            try:
+                with connection:
+                    for record in records:
+                        self.__apply_record(connection, record, truncate)
+            except Exception:
+                # Projects inserted by the transaction were rolled back
+                self.__project_ids = {}
+                raise
+
+    def __project_id(self, connection, project_key, create=False):
+        project_id = self.__project_ids.get(project_key)
+        if project_id is None:
+            row = connection.execute('SELECT id FROM projects WHERE key = ?', (project_key,)).fetchone()
+            if row:
+                project_id = row[0]
+            elif create:
+                project_id = connection.execute('INSERT INTO projects (key) VALUES (?)', (project_key,)).lastrowid
+            else:
+                return None
+            self.__project_ids[project_key] = project_id
+        return project_id
+
+    def __apply_record(self, connection, record, truncate):
+        op = record['op']
+        if op == 'add':
+            project_id = self.__project_id(connection, record['project'], create=True)
+            entry = HistoryEntry.coerce(record['entry'])
+            self.__seq += 1
+            connection.execute(
+                'INSERT OR REPLACE INTO entries'
+                ' (project_id, filename, type, "group", "index", timestamp, seq, count, score, rank)'
+                ' VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (project_id, entry.filename, record['type'], entry.group, entry.index,
+                 entry.timestamp, self.__seq, entry.count, entry.score, entry.rank())
+            )
+            max_entries = self.max_entries(record['project'])
+            if truncate and self.ranked() and max_entries > 0:
+                # Keep the new entry and the highest ranked others, so exactly `max_entries` remain
+                # (ties are broken by filename, like HistoryList.truncate)
+                connection.execute(
+                    'DELETE FROM entries WHERE project_id = ? AND type = ? AND seq != ? AND seq NOT IN ('
+                    '  SELECT seq FROM entries WHERE project_id = ? AND type = ? AND seq != ?'
+                    '  ORDER BY rank DESC, filename DESC LIMIT ?)',
+                    (project_id, record['type'], self.__seq, project_id, record['type'], self.__seq,
+                     max_entries - 1)
+                )
+            elif truncate:
+                # Evict everything older than the newest `max_entries` entries
+                connection.execute(
+                    'DELETE FROM entries WHERE project_id = ? AND type = ? AND seq <= ('
+                    '  SELECT seq FROM entries WHERE project_id = ? AND type = ?'
+                    '  ORDER BY seq DESC LIMIT 1 OFFSET ?)',
+                    (project_id, record['type'], project_id, record['type'], max(max_entries, 0))
+                )
+        elif op == 'remove':
+            project_id = self.__project_id(connection, record['project'])
+            if project_id is not None:
+                connection.execute('DELETE FROM entries WHERE project_id = ? AND filename = ?',
+                                   (project_id, record['filename']))
+        elif op == 'drop':
+            project_id = self.__project_id(connection, record['project'])
+            if project_id is not None:
+                connection.execute('DELETE FROM entries WHERE project_id = ?', (project_id,))
+                connection.execute('DELETE FROM projects WHERE id = ?', (project_id,))
+                del self.__project_ids[record['project']]
+        elif op == 'rename':
+            self.__apply_record(connection, {'op': 'drop', 'project': record['to']}, truncate)
+            project_id = self.__project_id(connection, record['project'])
+            if project_id is not None:
+                connection.execute('UPDATE projects SET key = ? WHERE id = ?', (record['to'], project_id))
+                del self.__project_ids[record['project']]
+                self.__project_ids[record['to']] = project_id
+        elif op == 'reset':
+            connection.execute('DELETE FROM entries')
+            connection.execute('DELETE FROM projects')
+            self.__project_ids = {}
+
+
+class ShardedHistoryStorage(object):
+    """Stores the history of every project in a JSON file of its own, in a directory.
+
+    Projects are loaded when they are needed and only the projects that changed are written back.
+    A manifest maps the project keys (which may be long paths) to the names of their files.
+    """
+
+    MANIFEST_FILE = 'projects.json'
+
+    def __init__(self, path, stats):
+        self.path = path
+        self.stats = stats
+        self.__lock = threading.Lock()
+        # Project key -> file name, read from the manifest on first use
+        self.__manifest = None
+
+    def __shard_path(self, shard):
+        return os.path.join(self.path, shard)
+
+    @staticmethod
+    def __shard_name(project_key):
+        if project_key == 'global':
+            return 'global.json'
+        return hashlib.md5(project_key.encode('utf-8')).hexdigest() + '.json'
+
+    def __read_manifest(self):
+        if self.__manifest is None:
+            try:
+                with open(self.__shard_path(self.MANIFEST_FILE), 'r') as f:
+                    self.__manifest = json.load(f)
+            except (OSError, ValueError):
+                self.__manifest = {}
+        return self.__manifest
+
+    def __write(self, shard, data):
+        # Write to a temporary file first so we never leave a truncated shard behind
+        path = self.__shard_path(shard)
+        with open(path + '.tmp', mode='w') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(path + '.tmp', path)
+        self.stats.add_bytes_written('history shards', len(data))
+
+    def exists(self):
+        return os.path.exists(self.__shard_path(self.MANIFEST_FILE))
+
+    def close(self):
+        pass
+
+    def project_keys(self):
+        with self.__lock:
+            return list(self.__read_manifest())
+
+    def load_project(self, project_key):
+        """Return the 'opened' and 'closed' HistoryLists of a single project"""
+        with self.__lock:
+            shard = self.__read_manifest().get(project_key)
+        project = {}
+        if shard is not None:
+            try:
+                with open(self.__shard_path(shard), 'r') as f:
+                    project = json.load(f)
+            except (OSError, ValueError) as e:
+                print('[FileHistory] Could not read the history shard of project "%s": %s: %s'
+                      % (project_key, e.__class__.__name__, e))
+        return {key: HistoryList([HistoryEntry.coerce(entry) for entry in project.get(key, ())])
+                for key in ('opened', 'closed')}
+
+    def changes(self, records, history):
+        """Copy the projects changed by the records (called while the history is locked).
+
+        Returns a dict of project key -> entries of the project, or None for projects that were removed.
+        The entries are serialized by `apply`, without holding the lock.
+        """
+        dirty = set()
+        removed = set()
+        for record in records:
+            op = record['op']
+            if op == 'reset':
+                removed.update(self.project_keys())
+                dirty.update(history)
+            elif op == 'drop':
+                removed.add(record['project'])
+            elif op == 'rename':
+                removed.add(record['project'])
+                dirty.add(record['to'])
+            else:
+                dirty.add(record['project'])
+
+        changes = dict.fromkeys(removed)
+        for project_key in dirty:
+            project = history.get(project_key)
+            if project is not None:
+                changes[project_key] = {'opened': project['opened'].snapshot(), 'closed': project['closed'].snapshot()}
+        return changes
+
+    def import_history(self, history):
+        """Replace the contents of the directory with history (e.g. loaded from the JSON file)"""
+        records = [{'op': 'reset'}]
+        self.apply(self.changes(records, history))
+
+    def apply(self, changes):
+        """Write the changed projects and then the manifest (if projects were added or removed)"""
+        with self.__lock:
+            if not os.path.isdir(self.path):
+                os.makedirs(self.path)
+            manifest = dict(self.__read_manifest())
+            for (project_key, project) in changes.items():
+                shard = manifest.get(project_key) or self.__shard_name(project_key)
+                if project is None:
+                    manifest.pop(project_key, None)
+                    try:
+                        os.remove(self.__shard_path(shard))
+                    except OSError:
+                        pass
+                else:
+                    manifest[project_key] = shard
+                    self.__write(shard, json.dumps(project, default=HistoryEntry.to_dict))
+            if manifest != self.__manifest or not self.exists():
+                self.__write(self.MANIFEST_FILE, json.dumps(manifest))
+                self.__manifest = manifest
+
+
 class FileHistory(metaclass=Singleton):
 
     SETTINGS_CALLBACK_KEY = 'FileHistory-reload'
@@ -30,16 +1497,137 @@ class FileHistory(metaclass=Singleton):
     DEFAULT_TIMESTAMP_FORMAT = '%Y-%m-%d @ %H:%M:%S'
     OLD_DEFAULT_TIMESTAMP_FORMAT = '%Y-%m-%d %H:%M:%S'
 
+    # Version of the history file format, stored in the file under SCHEMA_VERSION_KEY.
+    # Files without a version predate POSIX timestamps (v1.7.0).
+    SCHEMA_VERSION_KEY = 'schema_version'
+    SCHEMA_VERSION = 1
+
+    # Removals are stored under TOMBSTONES_KEY (if `sync_history` is enabled)
+    # so that merging the history of another instance doesn't bring back removed entries
+    TOMBSTONES_KEY = 'removed'
+    TOMBSTONE_TTL = 7 * 24 * 3600
+    MAX_TOMBSTONES = 1000
+
+    # Tab events that follow each other within this many seconds (like closing a window or all tabs)
+    # are collected and added to the history together, see `add_views`
+    BURST_INTERVAL = 0.05
+
+    # Seconds `sync_history` waits for other instances to unlock the history file before giving up (until next time)
+    SYNC_LOCK_TIMEOUT = 1.0
+
+    # Number of archived entries the quick panel loads at once
+    ARCHIVE_PAGE_SIZE = 50
+
+    # Seconds a cleanup (which runs in the background) spends checking the files, the remaining ones are kept
+    CLEANUP_TIMEOUT = 60
+
     def __init__(self):
         """Class to manage the file-access history"""
+        # Guards self.history against the background flusher
+        self.lock = threading.RLock()
+        self.__write_lock = threading.Lock()
+        self.__dirty = False
+
+        # window id -> ((folders, project file name), project key)
+        self.__project_keys = {}
+
+        # Date of the last backup made in this session
+        self.__last_backup_date = None
+
+        # Journal records waiting to be appended and whether a full snapshot is required instead
+        self.__journal_pending = []
+        self.__snapshot_pending = False
+        self.__journal_records = 0
+        self.__journal_size = 0
+
+        # Number of saves requested by mutations vs. actual writes to disk
+        self.save_requests = 0
+        self.save_writes = 0
+
+        # Timings of the hot operations, see the `performance_stats` setting
+        self.stats = PerfStats()
+
+        # The history is loaded asynchronously; events arriving earlier are queued
+        self.history = {}
+        self.loaded = False
+        self.__load_lock = threading.Lock()
+        self.__pending_events = []
+
+        # Tab events of the current burst (None outside of bursts) and the time of the latest event
+        self.__burst_events = None
+        self.__last_view_event = 0
+        # Held while captured events are applied, so later events and reads are ordered after them
+        self.__apply_lock = threading.RLock()
+
+        # Projects that exist in the storage but haven't been loaded into self.history yet
+        self.__unloaded_projects = set()
+        # Unloaded projects that a cleanup skipped, to be cleaned once they are loaded
+        self.__uncleaned_projects = set()
+
+        # For synchronizing with other instances (see `sync_history`):
+        # the history file and journal size as of our last read or write of them
+        # and (project or None, filename or None) -> time of the removals that have to survive merges
+        self.__disk_signature = None
+        self.__journal_offset = 0
+        self.__tombstones = {}
+
+        # Search index over the paths in all projects, built by the first search (see `search_history`)
+        self.__path_index = None
+        # Incremented whenever the index is dropped; (added, removed) entries while it is being built
+        self.__index_generation = 0
+        self.__index_changes = None
+        self.__index_build_lock = threading.Lock()
+
+        # The open views by window and file name (see `get_view_from_another_group`)
+        # and the resolved paths of the file names (see `real_path`)
+        self.open_views = OpenViewIndex()
+        self.real_paths = RealPathCache()
+
+        # (project key, ranked) -> the HistorySnapshot last returned by `get_history`
+        self.__snapshots = {}
+
+        # Evicted entries waiting to be appended to the archive (see `archive_evicted_entries`)
+        self.__archive_pending = []
+        # Project -> byte offsets of its records in the archive (in the order they were archived),
+        # the size of the archive they cover and the number of times it was compacted (see `read_archive`)
+        self.__archive_lock = threading.Lock()
+        self.__archive_offsets = {}
+        self.__archive_indexed = 0
+        self.__archive_generation = 0
+
+        # Number of the latest preview request (earlier ones that haven't run yet are cancelled)
+        # and filename -> view of the previews kept open while the panel is (see `preview_cache_size`)
+        self.__preview_request = 0
+        self.__preview_views = OrderedDict()
+        # Ids of the views opened as cached previews and the files whose preview is being opened,
+        # whose tab events don't belong in the history
+        self.__preview_view_ids = set()
+        self.__opening_previews = set()
+
+        # Ids of the views that were added to the history with their closing window (see `close_window`)
+        self.__closed_view_ids = set()
+
         self.__load_settings()
-        self.__load_history()
+        self.storage = self.__create_storage()
         self.__clear_context()
 
+        sublime.set_timeout_async(lambda: self.__startup(), 0)
+
+    def __startup(self):
+        self.ensure_loaded()
+
         if self.DELETE_ALL_ON_STARTUP:
-            sublime.set_timeout_async(lambda: self.delete_all_history(), 0)
+            self.delete_all_history()
         elif self.CLEANUP_ON_STARTUP:
-            sublime.set_timeout_async(lambda: self.clean_history(False), 0)
+            self.clean_history(False)
+
+    def ensure_loaded(self):
+        """Load the history if that didn't happen yet (blocks while another thread is loading it)"""
+        if self.loaded:
+            return
+        with self.__load_lock:
+            if not self.loaded:
+                self.__load_history()
 
     def __load_settings(self):
         """Load the plugin settings from FileHistory.sublime-settings"""
@@ -54,7 +1642,11 @@ class FileHistory(metaclass=Singleton):
         if not first_load:
             print('[FileHistory] Reloading the settings file "%s".' % (self.SETTINGS_FILE))
 
+        # The compiled patterns depend on the settings
+        self.__path_matchers = {}
+
         self.PRINT_DEBUG = self.__ensure_setting('debug', False)
+        self.stats.enabled = self.__ensure_setting('performance_stats', False)
 
         self.GLOBAL_MAX_ENTRIES = self.__ensure_setting('global_max_entries', 100)
         self.PROJECT_MAX_ENTRIES = self.__ensure_setting('project_max_entries', 50)
@@ -64,25 +1656,51 @@ class FileHistory(metaclass=Singleton):
 
         self.REMOVE_NON_EXISTENT_FILES = self.__ensure_setting('remove_non_existent_files_on_preview', True)
         self.CLEANUP_ON_STARTUP = self.__ensure_setting('cleanup_on_startup', True)
+        self.CLEANUP_WORKERS = self.__ensure_setting('cleanup_workers', 8)
         self.DELETE_ALL_ON_STARTUP = self.__ensure_setting('delete_all_on_startup', False)
         history_path = self.__ensure_setting('history_file', os.path.join('User', 'FileHistory.json'))
 
         self.HISTORY_FILE = os.path.normpath(os.path.join(sublime.packages_path(), history_path))
+        self.JOURNAL_FILE = os.path.splitext(self.HISTORY_FILE)[0] + '.journal'
+        self.ARCHIVE_FILE = os.path.splitext(self.HISTORY_FILE)[0] + '.archive'
+        self.ARCHIVE_EVICTED = self.__ensure_setting('archive_evicted_entries', False)
+        self.DATABASE_FILE = os.path.splitext(self.HISTORY_FILE)[0] + '.sqlite'
+        self.SHARD_DIR = os.path.splitext(self.HISTORY_FILE)[0] + '.shards'
+        self.HISTORY_BACKEND = self.__ensure_setting('history_backend', 'json')
+        self.HISTORY_ORDER = self.__ensure_setting('history_order', 'recent')
+        self.SYNC_HISTORY = self.__ensure_setting('sync_history', False)
+        self.LOCK_FILE = self.HISTORY_FILE + '.lock'
 
         self.USE_MONOSPACE = self.__ensure_setting('monospace_font', False)
         self.REAL_PATH = self.__ensure_setting('real_path', False)
+        self.real_paths.clear()
+        # Compare the open views with the (resolved) file names of the history entries
+        self.open_views.set_key(self.real_paths.resolve if self.REAL_PATH else None)
 
         self.TIMESTAMP_SHOW = self.__ensure_setting('timestamp_show', True)
         self.TIMESTAMP_FORMAT = self.__ensure_setting('timestamp_format', self.DEFAULT_TIMESTAMP_FORMAT)
         self.TIMESTAMP_MODE = self.__ensure_setting('timestamp_mode', 'history_access')
         self.TIMESTAMP_RELATIVE = self.__ensure_setting('timestamp_relative', True)
 
+        self.STAT_CACHE_TTL = self.__ensure_setting('stat_cache_ttl', 10)
+        self.STAT_TIMEOUT = self.__ensure_setting('stat_timeout_ms', 300) / 1000
+        self.SLOW_MOUNT_BACKOFF = self.__ensure_setting('slow_mount_backoff', 60)
+        self.stat_cache = StatCache(self.STAT_CACHE_TTL, self.STAT_TIMEOUT, self.SLOW_MOUNT_BACKOFF,
+                                    self.CLEANUP_WORKERS, max_size=2 * self.GLOBAL_MAX_ENTRIES)
+        self.real_paths.stat_cache = self.stat_cache
+
         self.PRETTIFY_HISTORY = self.__ensure_setting('prettify_history', False)
+        self.SAVE_DELAY = self.__ensure_setting('save_delay', 1000)
+
+        self.USE_JOURNAL = self.__ensure_setting('history_journal', False)
+        self.JOURNAL_MAX_RECORDS = self.__ensure_setting('journal_max_records', 1000)
+        self.JOURNAL_MAX_SIZE = self.__ensure_setting('journal_max_size_kb', 512) * 1024
 
         self.PATH_EXCLUDE_PATTERNS = self.__ensure_setting('path_exclude_patterns', [])
         self.PATH_REINCLUDE_PATTERNS = self.__ensure_setting('path_reinclude_patterns', [])
 
         self.MAX_BACKUP_COUNT = self.__ensure_setting('max_backup_count', 3)
+        self.COMPRESS_BACKUPS = self.__ensure_setting('compress_backups', False)
 
         # Test if the specified format string is valid
         try:
@@ -92,15 +1710,24 @@ class FileHistory(metaclass=Singleton):
             self.TIMESTAMP_FORMAT = self.DEFAULT_TIMESTAMP_FORMAT
 
         self.SHOW_FILE_PREVIEW = self.__ensure_setting('show_file_preview', True)
+        self.PREVIEW_DELAY = self.__ensure_setting('preview_delay', 100)
+        self.PREVIEW_MAX_SIZE = self.__ensure_setting('preview_max_size_kb', 4096) * 1024
+        self.PREVIEW_CACHE_SIZE = self.__ensure_setting('preview_cache_size', 0)
 
-    def get_history_timestamp(self, history_entry, action):
+    def get_history_timestamp(self, history_entry, action, stat_result=None):
+        """Return the action and timestamp to display (the stat result of the file is looked up if not given)"""
         timestamp = None
         filepath = history_entry['filename']
         if 'timestamp' in history_entry and self.TIMESTAMP_MODE == 'history_access':
             timestamp = history_entry['timestamp']
-        elif filepath and os.path.exists(filepath):
+        elif stat_result is not None and stat_result is not StatCache.UNAVAILABLE:
             action = 'modified'
-            timestamp = int(os.path.getmtime(filepath))
+            timestamp = int(stat_result.st_mtime)
+        elif filepath:
+            mtime = self.stat_cache.getmtime(filepath)
+            if mtime is not None:
+                action = 'modified'
+                timestamp = int(mtime)
         return (action, timestamp)
 
     def timestamp_from_string(self, timestamp):
@@ -127,31 +1754,72 @@ class FileHistory(metaclass=Singleton):
             self.debug('Setting "%s" not found.  Using the default value of %r' % (key, default_value))
         return value
 
-    def debug(self, text):
-        """Helper method for "logging" to the console."""
+    def debug(self, text, *args):
+        """Helper method for "logging" to the console.
+
+        The text is only formatted with args if debugging is enabled, so hot paths should pass them separately.
+        """
         if self.PRINT_DEBUG:
-            print('[FileHistory] ' + text)
+            print('[FileHistory] ' + (text % args if args else text))
+
+    def __create_storage(self):
+        """Create the storage for the `history_backend` setting (None for the JSON file)"""
+        if self.HISTORY_BACKEND == 'sharded':
+            return ShardedHistoryStorage(self.SHARD_DIR, self.stats)
+        if self.HISTORY_BACKEND != 'sqlite':
+            return None
+        if sqlite3 is None:
+            print('[FileHistory] The sqlite3 module is not available. Falling back to the JSON history file.')
+            return None
+        return SqliteHistoryStorage(self.DATABASE_FILE, self.max_entries, lambda: self.HISTORY_ORDER == 'frecency')
+
+    def max_entries(self, project_name):
+        return self.GLOBAL_MAX_ENTRIES if project_name == 'global' else self.PROJECT_MAX_ENTRIES
 
     def get_current_project_key(self):
         return self.get_project_key(sublime.active_window())
 
     def get_project_key(self, window):
+        """Return the project key of the window.
+
+        The key is cached per window until `refresh_project_key` detects a change of the project.
+        """
+        cached = self.__project_keys.get(window.id())
+        if cached is not None:
+            return cached[1]
+        return self.refresh_project_key(window)
+
+    def refresh_project_key(self, window):
+        """Recompute the project key of the window if its folders or project file changed"""
+        # Try to use project_file_name (available in ST3 build 3014)
+        project_filename = window.project_file_name() if hasattr(window, 'project_file_name') else None
+        signature = (tuple(window.folders()), project_filename)
+
+        cached = self.__project_keys.get(window.id())
+        if cached is not None and cached[0] == signature:
+            return cached[1]
+
+        project_key = self.__compute_project_key(*signature)
+        self.__project_keys[window.id()] = (signature, project_key)
+        return project_key
+
+    def __compute_project_key(self, folders, project_filename):
         m = hashlib.md5()
-        for path in window.folders():
+        for path in folders:
             m.update(path.encode('utf-8'))
         project_key = m.hexdigest()
 
-        # Try to use project_file_name (available in ST3 build 3014)
         # Note: Although it would be more appropriate, the name of the workspace is not available
-        if hasattr(window, 'project_file_name'):
-            project_filename = window.project_file_name()
-            if not project_filename:
-                return project_key
-
+        if project_filename:
             # migrate the history entry based on the "old" project key (if it exists)
-            if project_key in self.history:
-                self.history[project_filename] = self.history[project_key]
-                del self.history[project_key]
+            with self.lock:
+                project = self.__get_project(project_key)
+                if project is not None:
+                    self.history[project_filename] = project
+                    del self.history[project_key]
+                    self.__unloaded_projects.discard(project_filename)
+                    self.__log({'op': 'rename', 'project': project_key, 'to': project_filename})
+                    self.__save_history(journaled=True)
 
             # use the new project key
             project_key = project_filename
@@ -159,100 +1827,712 @@ class FileHistory(metaclass=Singleton):
         return project_key
 
     def __load_history(self):
-        self.history = {}
+        """Read the history file (and journal) and replace the current history with it.
+
+        The files are parsed without holding the lock; events queued in the meantime are applied afterwards.
+        """
+        start_time = time.perf_counter()
+        unloaded_projects = set()
+        import_history = False
+        if self.storage is not None and (self.storage.exists() or not os.path.exists(self.HISTORY_FILE)):
+            # Only load the global history, projects are loaded when they are needed
+            updated_history = {'global': self.storage.load_project('global')}
+            unloaded_projects = set(self.storage.project_keys()) - {'global'}
+            (trigger_save, records, journal_size, tombstones) = (False, [], 0, [])
+        else:
+            with self.__lock_history_file():
+                (updated_history, trigger_save, tombstones) = self.__read_history()
+                (records, journal_size) = self.__read_journal()
+                self.__disk_signature = self.__history_signature()
+            # One-time import of the JSON history into the database
+            import_history = self.storage is not None
+
+        with self.lock:
+            self.history = updated_history
+            self.__unloaded_projects = unloaded_projects
+            self.__uncleaned_projects = set()
+            self.__invalidate_index()
+            self.__snapshots = {}
+            if self.SYNC_HISTORY:
+                self.__tombstones = {(project_name, filename): removed_at
+                                     for (project_name, filename, removed_at) in tombstones}
+            self.__journal_offset = journal_size
+            # Apply the changes recorded since the last snapshot
+            for record in records:
+                self.__apply_record(record)
+            # The entries these records evicted were archived back then
+            self.__archive_pending = []
+            self.__journal_records = len(records)
+            self.__journal_size = journal_size
+
+            # Keys cached before the history was available skipped the legacy key migration,
+            # which has to happen before the events that were queued for the new keys are applied
+            for (signature, _) in list(self.__project_keys.values()):
+                self.__compute_project_key(*signature)
+            self.__project_keys = {}
+
+            # Apply the events that happened while loading
+            pending_events = self.__pending_events
+            self.__pending_events = []
+            for event in pending_events:
+                self.__apply_view_event(*event)
+
+            if import_history:
+                self.debug('Importing the history from %s into %s', self.HISTORY_FILE, self.storage.path)
+                self.storage.import_history(self.history)
+                # The imported history includes the changes recorded so far
+                self.__journal_pending = []
+
+            self.loaded = True
+
+        duration = time.perf_counter() - start_time
+        if self.stats.enabled:
+            self.stats.record('load history', duration)
+        self.debug('Loaded the history in %.3fs (%d queued events)', duration, len(pending_events))
+
+        if trigger_save:
+            # Save the changes
+            self.__save_history()
+        elif pending_events:
+            self.__save_history(journaled=True)
 
+    def __read_history(self):
+        """Parse and migrate the history file. Returns the same as `__parse_history`"""
         if not os.path.exists(self.HISTORY_FILE):
             self.debug("History file '%s' doesn't exist" % self.HISTORY_FILE)
-            return
+            updated_history = {self.SCHEMA_VERSION_KEY: self.SCHEMA_VERSION}
+        else:
+            self.debug('Loading the history from file ' + self.HISTORY_FILE)
+            try:
+                with open(self.HISTORY_FILE, 'r') as f:
+                    updated_history = json.load(f)
+            except Exception as e:
+                updated_history = {self.SCHEMA_VERSION_KEY: self.SCHEMA_VERSION}
+                sublime.error_message(
+                    dedent("""\
+                           File History could not read your history file at '%s'.
+
+                           %s: %s""")
+                    % (self.HISTORY_FILE, e.__class__.__name__, e)
+                )
+
+        return self.__parse_history(updated_history)
+
+    def __parse_history(self, updated_history):
+        """Migrate and index the contents of a history file.
+
+        Returns the history, whether it needs to be saved and the stored tombstones.
+        """
+        # Do cleanup on the history file
+        schema_version = updated_history.pop(self.SCHEMA_VERSION_KEY, 0)
+        tombstones = updated_history.pop(self.TOMBSTONES_KEY, [])
+        updated_history.setdefault('global', {'opened': [], 'closed': []})
+        trigger_save = schema_version < self.SCHEMA_VERSION
+
+        if schema_version < 1:
+            self.__migrate_to_posix_timestamps(updated_history)
+
+        # Index the entry lists and share identical entries between projects
+        # (every entry of a project usually also exists in 'global')
+        shared_entries = {}
+        for project in updated_history.values():
+            for key in ('closed', 'opened'):
+                entries = []
+                for entry in project[key]:
+                    entry = HistoryEntry.coerce(entry)
+                    identity = (entry.filename, entry.group, entry.index, entry.timestamp, entry.count, entry.score)
+                    entries.append(shared_entries.setdefault(identity, entry))
+                project[key] = HistoryList(entries)
+
+        return (updated_history, trigger_save, tombstones)
+
+    def __migrate_to_posix_timestamps(self, history):
+        """Migrate old formatted timestamps to POSIX time and remove the 'action' fields"""
+        self.debug("Migrating the history to POSIX timestamps")
+        for project in history.values():
+            for key in ('closed', 'opened'):
+                for entry in project[key]:
+                    if not isinstance(entry.get('timestamp', 0), int):
+                        new_stamp = self.timestamp_from_string(entry['timestamp'])
+                        if not new_stamp:
+                            del entry['timestamp']
+                        else:
+                            entry['timestamp'] = new_stamp
+                    entry.pop('action', None)
+
+    def __read_journal(self, offset=0):
+        """Parse the journal, starting at byte `offset`. Returns the records and the size of the journal"""
+        records = []
+        if not os.path.exists(self.JOURNAL_FILE):
+            return (records, 0)
 
-        self.debug('Loading the history from file ' + self.HISTORY_FILE)
+        self.debug('Reading the history journal %s from offset %d', self.JOURNAL_FILE, offset)
+        size = offset
         try:
-            with open(self.HISTORY_FILE, 'r') as f:
-                updated_history = json.load(f)
+            with open(self.JOURNAL_FILE, 'rb') as f:
+                f.seek(offset)
+                for line in f:
+                    size += len(line)
+                    try:
+                        records.append(json.loads(line.decode('utf-8')))
+                    except ValueError:
+                        # Most likely the last record was only partially written
+                        self.debug('Skipping corrupt journal record: %r' % line)
         except Exception as e:
-            updated_history = {}
-            sublime.error_message(
-                dedent("""\
-                       File History could not read your history file at '%s'.
+            print('[FileHistory] Could not read the history journal at "%s": %s: %s'
+                  % (self.JOURNAL_FILE, e.__class__.__name__, e))
+        return (records, size)
+
+    def __apply_record(self, record):
+        if record['op'] == 'add':
+            self.__insert_entry(record['project'], record['type'], record['entry'])
+        elif record['op'] == 'remove':
+            self.__discard(record['project'], record['filename'])
+        elif record['op'] == 'drop':
+            self.history.pop(record['project'], None)
+            self.__invalidate_index()
+        elif record['op'] == 'rename':
+            if record['project'] in self.history:
+                self.history[record['to']] = self.history.pop(record['project'])
+        elif record['op'] == 'reset':
+            self.history = {}
+            self.__invalidate_index()
+
+    def __lock_history_file(self, timeout=None):
+        """Return a context manager that locks the history file against other instances (if `sync_history` is enabled)"""
+        if not self.SYNC_HISTORY or self.storage is not None:
+            return _NullLock()
+        return FileLock(self.LOCK_FILE, timeout)
+
+    def __history_signature(self):
+        """Identify the current version of the history file (or None if it doesn't exist)"""
+        try:
+            result = os.stat(self.HISTORY_FILE)
+        except OSError:
+            return None
+        return (result.st_mtime_ns, result.st_size, result.st_ino)
 
-                       %s: %s""")
-                % (self.HISTORY_FILE, e.__class__.__name__, e)
-            )
-        self.history = updated_history
+    def sync_history(self):
+        """Merge the changes that other instances saved to the history file (if `sync_history` is enabled).
 
-        # Do cleanup on the history file
-        self.__ensure_project('global')
-        trigger_save = False
-
-        # Migrate old formatted timestamps and convert to POSIX
-        hlist = updated_history['global']['closed'] or updated_history['global']['opened']
-        if hlist and 'timestamp' in hlist[0] and not isinstance(hlist[0]['timestamp'], int):
-            # Found an old timestamp. Likely that all others are old too
-            self.debug("Found an old-style formatted timestamp. Migrating to POSIX")
-            for project in updated_history.values():
-                for key in ('closed', 'opened'):
-                    for entry in project[key]:
-                        if not isinstance(entry.get('timestamp', 0), int):
-                            new_stamp = self.timestamp_from_string(entry['timestamp'])
-                            if not new_stamp:
-                                del entry['timestamp']
-                            else:
-                                entry['timestamp'] = new_stamp
-            trigger_save = True
-        # Remove actions keys
-        if hlist and 'action' in hlist[0]:
-            self.debug("Found an old-style action field. Cleaning up")
-            trigger_save = True
-            for project in updated_history.values():
-                for key in ('closed', 'opened'):
-                    for entry in project[key]:
-                        if 'action' in entry:
-                            del entry['action']
+        Gives up if another instance keeps the history file locked for SYNC_LOCK_TIMEOUT,
+        the changes are merged by the next sync (or write) then.
+        """
+        if not self.SYNC_HISTORY or self.storage is not None or not self.loaded:
+            return
+        with self.__write_lock, self.__lock_history_file(self.SYNC_LOCK_TIMEOUT) as lock:
+            if lock.locked:
+                self.__merge_changes()
+
+    def __merge_changes(self):
+        """Merge what other instances wrote since we last read or wrote the history file or journal.
+
+        Only the journal records appended since then are read, unless another instance wrote a new snapshot.
+        Must be called with the history file locked.
+        """
+        signature = self.__history_signature()
+        if signature != self.__disk_signature:
+            # Another instance wrote a snapshot (and removed the journal it contained)
+            self.debug('The history file was written by another instance, merging it')
+            (remote, _, tombstones) = self.__read_history()
+            (records, journal_size) = self.__read_journal()
+            journal_records = len(records)
+        else:
+            offset = self.__journal_offset
+            journal_size = os.path.getsize(self.JOURNAL_FILE) if os.path.exists(self.JOURNAL_FILE) else 0
+            if journal_size == offset:
+                return
+            if journal_size < offset:
+                # The journal was replaced; merging the records again is harmless
+                offset = 0
+            (remote, tombstones) = ({}, [])
+            (records, journal_size) = self.__read_journal(offset)
+            journal_records = self.__journal_records + len(records)
+
+        merged = 0
+        with self.lock:
+            for (project_name, filename, removed_at) in tombstones:
+                merged += self.__apply_tombstone(project_name, filename, removed_at)
+            for (project_name, project) in remote.items():
+                for history_type in ('opened', 'closed'):
+                    # Oldest first, so the entries with the same timestamp keep their order
+                    for entry in reversed(project[history_type].to_list()):
+                        merged += self.__merge_entry(project_name, history_type, entry)
+            for record in records:
+                merged += self.__merge_record(record)
+
+            self.__disk_signature = signature
+            self.__journal_offset = journal_size
+            self.__journal_records = journal_records
+            self.__journal_size = journal_size
+        self.debug('Merged %d changes of other instances (%d journal records)', merged, len(records))
+
+    def __merge_record(self, record):
+        """Apply a journal record written by another instance. Returns the number of changed entries"""
+        if record['op'] == 'add':
+            entry = HistoryEntry.coerce(record['entry'])
+            return self.__merge_entry(record['project'], record['type'], entry)
+        elif 'time' in record and record['op'] in ('remove', 'drop', 'reset'):
+            return self.__apply_tombstone(record.get('project'), record.get('filename'), record['time'])
+        self.__apply_record(record)
+        return 1
+
+    def __merge_entry(self, project_name, history_type, entry):
+        """Add an entry of another instance unless we have a newer one or removed it later. Returns 1 if added"""
+        timestamp = entry.timestamp or 0
+        for key in ((None, None), (project_name, None), (project_name, entry.filename)):
+            if self.__tombstones.get(key, -1) >= timestamp:
+                return 0
+
+        project = self.__get_project(project_name)
+        if project is not None:
+            for key in ('opened', 'closed'):
+                local = project[key].get(entry.filename)
+                if local is not None and (local.timestamp or 0) >= timestamp:
+                    return 0
+            self.__discard(project_name, entry.filename)
+        else:
+            project = self.__get_project(project_name, create=True)
+
+        history_list = project[history_type]
+        history_list.insert(entry)
+        evicted = history_list.truncate(self.max_entries(project_name), self.HISTORY_ORDER == 'frecency')
+        self.__update_index([entry])
+        self.__evicted(project_name, history_type, evicted)
+        return 1
+
+    def __add_tombstone(self, project_name, filename):
+        """Remember a removal (of a file, a whole project if filename is None or everything if both are None)"""
+        removed_at = int(time.time())
+        if self.SYNC_HISTORY:
+            self.__tombstones[(project_name, filename)] = removed_at
+        return removed_at
+
+    def __apply_tombstone(self, project_name, filename, removed_at):
+        """Remove the entries covered by a removal of another instance that are older than it.
+
+        Returns the number of removed entries.
+        """
+        key = (project_name, filename)
+        if self.__tombstones.get(key, -1) >= removed_at:
+            return 0
+        self.__tombstones[key] = removed_at
+
+        removed = 0
+        project_names = list(self.history) if project_name is None else [project_name]
+        for name in project_names:
+            project = self.history.get(name)
+            if project is None:
+                continue
+            for history_type in ('opened', 'closed'):
+                history_list = project[history_type]
+                entries = list(history_list) if filename is None else [history_list.get(filename)]
+                for entry in entries:
+                    if entry is not None and (entry.timestamp or 0) <= removed_at:
+                        history_list.remove(entry.filename)
+                        self.__update_index(removed=[entry])
+                        removed += 1
+        return removed
+
+    def __pruned_tombstones(self):
+        """Forget expired tombstones and return the remaining ones in the format of the history file"""
+        expired = time.time() - self.TOMBSTONE_TTL
+        tombstones = sorted(((removed_at, project_name, filename)
+                             for ((project_name, filename), removed_at) in self.__tombstones.items()
+                             if removed_at > expired), reverse=True)[:self.MAX_TOMBSTONES]
+        self.__tombstones = {(project_name, filename): removed_at
+                             for (removed_at, project_name, filename) in tombstones}
+        return [[project_name, filename, removed_at] for (removed_at, project_name, filename) in tombstones]
+
+    def __log(self, record):
+        """Record a single mutation for the journal or database (if enabled)"""
+        if self.USE_JOURNAL or self.storage is not None:
+            self.__journal_pending.append(record)
+
+    def __save_history(self, journaled=False):
+        """Mark the history as dirty and schedule a write-behind flush.
+
+        Multiple saves within `save_delay` milliseconds are coalesced into a single write.
+        If all changes since the last save were recorded with `__log`,
+        pass `journaled=True` so they may be appended to the journal instead of writing a snapshot.
+        """
+        with self.lock:
+            self.save_requests += 1
+            if not journaled or not self.USE_JOURNAL:
+                self.__snapshot_pending = True
+            if self.__dirty:
+                return
+            self.__dirty = True
+
+        sublime.set_timeout_async(lambda: self.flush_history(), max(0, self.SAVE_DELAY))
+
+    def flush_history(self):
+        """Write the history to disk if it has pending changes"""
+        with self.stats.timed('flush history'):
+            self.__flush_history()
+
+    def __flush_history(self):
+        with self.__write_lock, self.__lock_history_file():
+            if self.SYNC_HISTORY and self.storage is None:
+                # Don't overwrite what other instances saved in the meantime
+                self.__merge_changes()
+
+            with self.lock:
+                if not self.__dirty:
+                    return
+                self.__dirty = False
+                records = self.__journal_pending
+                self.__journal_pending = []
+                archived = self.__archive_pending
+                self.__archive_pending = []
+                self.save_writes += 1
+
+                if self.storage is not None:
+                    # The storage is always updated incrementally
+                    self.__snapshot_pending = False
+                    changes = self.storage.changes(records, self.history)
+                    history = lines = None
+                else:
+                    lines = ''.join(json.dumps(record, default=HistoryEntry.to_dict) + '\n' for record in records)
+
+                    # Compact the journal into a fresh snapshot once it grows too large
+                    compact = (
+                        self.__journal_records + len(records) > self.JOURNAL_MAX_RECORDS
+                        or self.__journal_size + len(lines) > self.JOURNAL_MAX_SIZE
+                    )
+                    if self.__snapshot_pending or compact or not self.USE_JOURNAL:
+                        self.__snapshot_pending = False
+                        # Only copy the lists here, they are serialized after releasing the lock
+                        history = {project_name: {history_type: history_list.snapshot()
+                                                  for (history_type, history_list) in project.items()}
+                                   for (project_name, project) in self.history.items()}
+                        history[self.SCHEMA_VERSION_KEY] = self.SCHEMA_VERSION
+                        if self.__tombstones:
+                            history[self.TOMBSTONES_KEY] = self.__pruned_tombstones()
+                    else:
+                        history = None
+
+            if archived:
+                self.__append_to_archive(archived)
+
+            if self.storage is not None:
+                self.debug('Applying %d records to the history storage %s', len(records), self.storage.path)
+                try:
+                    self.storage.apply(changes)
+                except Exception as e:
+                    print('[FileHistory] Could not update the history storage "%s": %s: %s'
+                          % (self.storage.path, e.__class__.__name__, e))
+                    # The changes are computed from the records again
+                    self.__retry_flush(records)
+                return
 
-        if trigger_save:
-            # Save the changes
-            self.__save_history()
+            if history is None:
+                self.debug('Appending %d records to the history journal %s', len(records), self.JOURNAL_FILE)
+                try:
+                    with open(self.JOURNAL_FILE, mode='a') as f:
+                        f.write(lines)
+                        f.flush()
+                        os.fsync(f.fileno())
+                except OSError as e:
+                    print('[FileHistory] Could not append to the history journal "%s": %s: %s'
+                          % (self.JOURNAL_FILE, e.__class__.__name__, e))
+                    # Part of the records might have been written, a snapshot replaces them
+                    self.__retry_flush(records, snapshot=True)
+                    return
+                self.stats.add_bytes_written('journal', len(lines))
+                self.__journal_records += len(records)
+                self.__journal_size += len(lines)
+                self.__journal_offset = os.path.getsize(self.JOURNAL_FILE)
+                return
 
-    def __save_history(self):
-        self.debug('Saving the history to file ' + self.HISTORY_FILE)
-        with open(self.HISTORY_FILE, mode='w+') as f:
+            self.debug('Saving the history to file %s (%d saves requested, %d written)',
+                       self.HISTORY_FILE, self.save_requests, self.save_writes)
             indent = self.INDENT_SIZE if self.PRETTIFY_HISTORY else None
+            data = json.dumps(history, indent=indent, default=HistoryEntry.to_dict)
+            # Write to a temporary file first so we never leave a truncated history behind
+            temp_file = self.HISTORY_FILE + '.tmp'
+            try:
+                with open(temp_file, mode='w') as f:
+                    f.write(data)
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(temp_file, self.HISTORY_FILE)
+            except OSError as e:
+                print('[FileHistory] Could not save the history to "%s": %s: %s'
+                      % (self.HISTORY_FILE, e.__class__.__name__, e))
+                self.__retry_flush(records, snapshot=True)
+                return
+            self.stats.add_bytes_written('history file', len(data))
+            self.__disk_signature = self.__history_signature()
+
+            # The snapshot now contains everything the journal did (including what a failed append left behind)
+            if self.__journal_records or os.path.exists(self.JOURNAL_FILE):
+                try:
+                    os.remove(self.JOURNAL_FILE)
+                except OSError:
+                    pass
+            self.__journal_records = 0
+            self.__journal_size = 0
+            self.__journal_offset = 0
+
+        self.__manage_backups()
+
+    def __retry_flush(self, records, snapshot=False):
+        """Put the records of a failed flush back in front of the pending ones and flush again later"""
+        with self.lock:
+            self.__journal_pending[:0] = records
+            if snapshot:
+                self.__snapshot_pending = True
+            if self.__dirty:
+                # Another flush is scheduled already
+                return
+            self.__dirty = True
 
-            json.dump(self.history, f, indent=indent)
-            f.flush()
-
-        sublime.set_timeout_async(lambda: self.__manage_backups(), 0)
+        sublime.set_timeout_async(lambda: self.flush_history(), max(0, self.SAVE_DELAY))
 
     def __manage_backups(self):
         # Only keep backups if the user wants them
         if self.MAX_BACKUP_COUNT <= 0:
             return
 
+        # Backups are made (and pruned) at most once a day, which we remember to avoid touching the disk
+        datestamp = time.strftime('%Y%m%d')
+        if self.__last_backup_date == datestamp:
+            return
+        self.__last_backup_date = datestamp
+
         # Make sure there is a backup of the history for today
         (root, ext) = os.path.splitext(self.HISTORY_FILE)
-        datestamp = time.strftime('%Y%m%d')
         backup = '%s_%s%s' % (root, datestamp, ext)
-        if not os.path.exists(backup):
+        if not os.path.exists(backup) and not os.path.exists(backup + '.gz'):
             self.debug('Backing up the history file for %s' % datestamp)
-            shutil.copy(self.HISTORY_FILE, backup)
+            if self.COMPRESS_BACKUPS:
+                backup += '.gz'
+                with open(self.HISTORY_FILE, 'rb') as source, gzip.open(backup, 'wb') as target:
+                    shutil.copyfileobj(source, target)
+            else:
+                shutil.copy(self.HISTORY_FILE, backup)
+            if self.stats.enabled:
+                self.stats.add_bytes_written('backups', os.path.getsize(backup))
 
         # Limit the number of backup files to keep
-        listing = sorted(glob.glob('%s_*%s' % (root, ext)), reverse=True)
+        listing = self.list_backups()
         if len(listing) > self.MAX_BACKUP_COUNT:
             for discard_file in listing[self.MAX_BACKUP_COUNT:]:
                 self.debug('Discarding old backup %s' % discard_file)
                 os.remove(discard_file)
 
+    def list_backups(self):
+        """Return the paths of all (compressed or uncompressed) backups, newest first"""
+        (root, ext) = os.path.splitext(self.HISTORY_FILE)
+        listing = glob.glob('%s_*%s' % (root, ext)) + glob.glob('%s_*%s.gz' % (root, ext))
+        return sorted(listing, reverse=True)
+
+    def read_backup(self, backup):
+        """Return the contents of a backup file as stored in the history file"""
+        opener = gzip.open if backup.endswith('.gz') else open
+        with opener(backup, 'rt') as f:
+            return json.load(f)
+
+    def restore_backup(self, backup):
+        """Replace the entire history with the contents of a backup file"""
+        self.ensure_loaded()
+        self.debug('Restoring the history from backup %s' % backup)
+        try:
+            (history, _, _) = self.__parse_history(self.read_backup(backup))
+        except Exception as e:
+            sublime.error_message("File History could not read the backup at '%s'.\n\n%s: %s"
+                                  % (backup, e.__class__.__name__, e))
+            return
+
+        with self.lock:
+            self.history = history
+            self.__unloaded_projects = set()
+            self.__uncleaned_projects = set()
+            self.__invalidate_index()
+            self.__snapshots = {}
+            # Pending changes are obsolete, but the database needs to be rebuilt with the restored entries
+            self.__journal_pending = []
+            if self.storage is not None:
+                self.__log({'op': 'reset'})
+                for (project_name, project) in history.items():
+                    for history_type in ('opened', 'closed'):
+                        for entry in reversed(project[history_type].to_list()):
+                            self.__log({'op': 'add', 'project': project_name, 'type': history_type,
+                                        'entry': entry})
+        self.__save_history()
+        sublime.status_message("File history restored from %s" % os.path.basename(backup))
+
     def delete_all_history(self):
-        self.history = {}
+        self.ensure_loaded()
+        with self.lock:
+            self.history = {}
+            self.__unloaded_projects = set()
+            self.__uncleaned_projects = set()
+            self.__invalidate_index()
+            self.__snapshots = {}
+            self.__tombstones = {}
+            removed_at = self.__add_tombstone(None, None)
+            self.__log({'op': 'reset', 'time': removed_at})
+            self.__archive_pending = []
+        with self.__write_lock, self.__archive_lock:
+            try:
+                os.remove(self.ARCHIVE_FILE)
+            except OSError:
+                pass
+            self.__reset_archive_offsets()
         self.__save_history()
 
-    def get_history(self, current_project_only=True):
-        """Return a copy of the requested history (global or project-specific): closed files followed by opened files"""
-        # Make sure the history is loaded
-        # TODO: If we have loaded history previously we should cache it and not access the file system again
-        if len(self.history) == 0:
-            self.__load_history()
+    def __append_to_archive(self, archived):
+        self.debug('Archiving %d evicted entries in %s', len(archived), self.ARCHIVE_FILE)
+        lines = ''.join(json.dumps(record) + '\n' for record in archived)
+        try:
+            with self.__archive_lock, open(self.ARCHIVE_FILE, mode='a') as f:
+                f.write(lines)
+            self.stats.add_bytes_written('archive', len(lines))
+        except OSError as e:
+            print('[FileHistory] Could not write to the archive "%s": %s: %s'
+                  % (self.ARCHIVE_FILE, e.__class__.__name__, e))
+
+    def has_archive(self):
+        return self.ARCHIVE_EVICTED and os.path.exists(self.ARCHIVE_FILE)
+
+    def read_archive(self, project_name, cursor=None, seen=None):
+        """Return a page of archived entries of a project, most recently archived first.
+
+        Continues before `cursor` (from the end by default) and skips the files in `seen`,
+        to which the returned (and removed) files are added. Returns a list of (history type, entry)
+        and the cursor to continue from (None at the beginning of the archive).
+        Reads the file, so it should be called on the async thread.
+        """
+        seen = set() if seen is None else seen
+        page = []
+        if not self.has_archive():
+            return (page, None)
+
+        with self.lock:
+            # Removals that weren't written to the archive yet
+            seen.update(record['filename'] for record in self.__archive_pending
+                        if 'entry' not in record and record['project'] == project_name)
+
+        with self.__archive_lock:
+            self.__update_archive_offsets()
+            offsets = self.__archive_offsets.get(project_name, [])
+            (generation, position) = cursor or (self.__archive_generation, len(offsets))
+            if generation != self.__archive_generation:
+                # Compacted meanwhile, start over (the files that were shown already are skipped)
+                position = len(offsets)
+            try:
+                with open(self.ARCHIVE_FILE, 'rb') as f:
+                    while position > 0:
+                        position -= 1
+                        f.seek(offsets[position])
+                        try:
+                            record = json.loads(f.readline().decode('utf-8'))
+                        except ValueError:
+                            continue
+                        if 'entry' not in record:
+                            # Removed from the history, its earlier records don't count
+                            seen.add(record['filename'])
+                            continue
+                        if record['entry']['filename'] in seen:
+                            continue
+                        entry = HistoryEntry.coerce(record['entry'])
+                        seen.add(entry.filename)
+                        page.append((record['type'], entry))
+                        if len(page) == self.ARCHIVE_PAGE_SIZE:
+                            return (page, (generation, position) if position else None)
+            except OSError:
+                pass
+        return (page, None)
+
+    def __update_archive_offsets(self):
+        """Index the records appended to the archive since the last call (with the archive lock held)"""
+        try:
+            if os.path.getsize(self.ARCHIVE_FILE) < self.__archive_indexed:
+                # Replaced (e.g. deleted and archived to again)
+                self.__reset_archive_offsets()
+            with open(self.ARCHIVE_FILE, 'rb') as f:
+                offset = f.seek(self.__archive_indexed)
+                for line in f:
+                    try:
+                        project_name = json.loads(line.decode('utf-8'))['project']
+                        self.__archive_offsets.setdefault(project_name, []).append(offset)
+                    except ValueError:
+                        pass
+                    offset += len(line)
+                self.__archive_indexed = offset
+        except OSError:
+            self.__reset_archive_offsets()
+
+    def __reset_archive_offsets(self):
+        self.__archive_offsets = {}
+        self.__archive_indexed = 0
+        self.__archive_generation += 1
+
+    def __compact_archive(self, existing):
+        """Rewrite the archive with only the latest record of every file of each project.
+
+        The records of files that are in the history of their project again, were removed from it
+        or don't exist according to `existing` and the records of removed projects are dropped as well.
+        """
+        with self.lock:
+            current = {project_name: set(entry.filename for history_type in ('opened', 'closed')
+                                         for entry in project[history_type])
+                       for (project_name, project) in self.history.items()}
+            projects = set(self.history) | self.__unloaded_projects | {'global'}
+
+        with self.__archive_lock:
+            # Later records replace (and move behind) the earlier ones of the same file
+            records = OrderedDict()
+            count = 0
+            try:
+                with open(self.ARCHIVE_FILE, 'rb') as f:
+                    for line in f:
+                        count += 1
+                        try:
+                            record = json.loads(line.decode('utf-8'))
+                        except ValueError:
+                            continue
+                        removal = 'entry' not in record
+                        key = (record['project'], record['filename'] if removal else record['entry']['filename'])
+                        records.pop(key, None)
+                        records[key] = None if removal else line if line.endswith(b'\n') else line + b'\n'
+            except OSError:
+                return
+
+            lines = [line for ((project_name, filename), line) in records.items()
+                     if line is not None and project_name in projects and filename not in current.get(project_name, ())
+                     and existing.get(filename, True)]
+            if len(lines) == count:
+                return
+            self.debug('Compacting the archive from %d to %d records', count, len(lines))
+            data = b''.join(lines)
+            try:
+                with open(self.ARCHIVE_FILE + '.tmp', mode='wb') as f:
+                    f.write(data)
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(self.ARCHIVE_FILE + '.tmp', self.ARCHIVE_FILE)
+            except OSError as e:
+                print('[FileHistory] Could not compact the archive "%s": %s: %s'
+                      % (self.ARCHIVE_FILE, e.__class__.__name__, e))
+                return
+            self.stats.add_bytes_written('archive', len(data))
+            self.__reset_archive_offsets()
+
+    def get_history(self, current_project_only=True, order=None):
+        """Return a HistorySnapshot of the requested history (global or project-specific).
+
+        The files are ordered by `order` ('recent' or 'frecency'), which defaults to the `history_order` setting.
+        Snapshots are shared until the history changes, so they must not be modified.
+        """
+        # Make sure the history is loaded and includes the latest tab events
+        self.ensure_loaded()
+        self.flush_view_events()
+        # Merge the changes of other instances in the background (the file might be locked or on a slow share),
+        # they are included the next time
+        sublime.set_timeout_async(lambda: self.sync_history(), 0)
 
         # Load the requested history (global or project-specific)
         if current_project_only:
@@ -261,146 +2541,485 @@ class FileHistory(metaclass=Singleton):
             self.project_name = 'global'
 
         # Return the list of closed and opened files
-        if self.project_name in self.history:
-            # Return a copy of the contained lists in history (the only actually mutated objects)
-            history = self.history[self.project_name]
-            return dict(opened=history['opened'][:], closed=history['closed'][:])
+        ranked = (order or self.HISTORY_ORDER) == 'frecency'
+        with self.lock:
+            history = self.__get_project(self.project_name)
+            if history is not None:
+                version = (history['closed'].version, history['opened'].version)
+                snapshot = self.__snapshots.get((self.project_name, ranked))
+                if snapshot is None or snapshot.version != version:
+                    snapshot = HistorySnapshot(history['closed'].snapshot(ranked), history['opened'].snapshot(ranked),
+                                               version)
+                    self.__snapshots[(self.project_name, ranked)] = snapshot
+                return snapshot
+        self.debug('WARN: Project %s could not be found in the file history list - returning an empty history list',
+                   self.project_name)
+        return HistorySnapshot()
+
+    def __evicted(self, project_name, history_type, evicted):
+        """Archive (if enabled) and unindex the entries that were evicted from a full history list"""
+        if self.ARCHIVE_EVICTED:
+            self.__archive_pending.extend({'project': project_name, 'type': history_type, 'entry': entry.to_dict()}
+                                          for entry in evicted)
         else:
-            self.debug('WARN: Project %s could not be found in the file history list - returning an empty history list' % (self.project_name))
-            return dict(opened=[], closed=[])
+            # Archived files remain searchable
+            self.__update_index(removed=evicted)
+
+    def __get_project(self, project_name, create=False):
+        """Return the history of a project (loading it from the storage if necessary) or None.
+
+        With `create`, make sure the project nodes exist (including 'opened' and 'closed').
+        """
+        project = self.history.get(project_name)
+        if project is None and project_name in self.__unloaded_projects:
+            self.debug('Loading the history of project "%s"', project_name)
+            self.__unloaded_projects.discard(project_name)
+            project = self.history[project_name] = self.storage.load_project(project_name)
+            if project_name in self.__uncleaned_projects:
+                self.__uncleaned_projects.discard(project_name)
+                sublime.set_timeout_async(lambda: self.__clean_projects([project_name]), 0)
+        if project is None and create:
+            project = self.history[project_name] = {'opened': HistoryList(), 'closed': HistoryList()}
+        return project
+
+    def __drop_project(self, project_name):
+        self.history.pop(project_name, None)
+        self.__unloaded_projects.discard(project_name)
+        self.__uncleaned_projects.discard(project_name)
+        self.__invalidate_index()
+        removed_at = self.__add_tombstone(project_name, None)
+        self.__log({'op': 'drop', 'project': project_name, 'time': removed_at})
+
+    def search_history(self, query, limit):
+        """Return up to limit paths from the history of any project that match query, best matches first"""
+        index = self.prepare_search()
+        # The index is kept up to date under the lock
+        with self.lock:
+            return index.search(query, limit)
+
+    def prepare_search(self):
+        """Build the search index (if that didn't happen yet) and return it
+
+        The index is built from a copy of the history without holding the lock,
+        so tab events aren't blocked meanwhile; the changes made in the meantime are replayed afterwards.
+        """
+        self.ensure_loaded()
+        self.flush_view_events()
+        with self.__index_build_lock:
+            while True:
+                with self.lock:
+                    if self.__path_index is not None:
+                        return self.__path_index
+                    start_time = time.time()
+                    generation = self.__index_generation
+                    unloaded_projects = list(self.__unloaded_projects)
+                    snapshots = [project[history_type].snapshot()
+                                 for project in self.history.values() for history_type in ('opened', 'closed')]
+                    archive_pending = list(self.__archive_pending)
+                    self.__index_changes = []
+
+                # Unloaded projects don't change until they are loaded, which `__get_project` does under the lock.
+                # They are only read for the index and stay unloaded, so searching doesn't keep them in memory.
+                loaded_projects = [self.storage.load_project(project_name) for project_name in unloaded_projects]
+                # Oldest first, so the most recent of the entries with the same timestamp ranks first
+                index = PathIndex()
+                for entries in snapshots:
+                    for entry in reversed(entries):
+                        index.add(entry.filename, entry.timestamp)
+                for project in loaded_projects:
+                    for history_type in ('opened', 'closed'):
+                        for entry in reversed(project[history_type].to_list()):
+                            index.add(entry.filename, entry.timestamp)
+                if self.ARCHIVE_EVICTED:
+                    self.__index_archive(index, archive_pending)
+
+                with self.lock:
+                    changes = self.__index_changes
+                    self.__index_changes = None
+                    if generation != self.__index_generation:
+                        # The history was replaced meanwhile (reloaded, restored or reset)
+                        continue
+                    for (added, removed) in changes:
+                        for entry in added:
+                            index.add(entry.filename, entry.timestamp)
+                        for entry in removed:
+                            index.remove(entry.filename)
+                    self.__path_index = index
+                    self.debug('Indexed %d paths for searching in %.3fs', len(index), time.time() - start_time)
+                    return index
+
+    def __index_archive(self, index, pending):
+        """Add the files in the archive to the search index (once each, with their latest timestamp)"""
+        # (project, filename) -> latest timestamp, unless removed since
+        archived = {}
+        records = []
+        try:
+            with open(self.ARCHIVE_FILE, 'rb') as f:
+                for line in f:
+                    try:
+                        records.append(json.loads(line.decode('utf-8')))
+                    except ValueError:
+                        pass
+        except OSError:
+            pass
+        # The pending records are the most recent ones
+        for record in records + list(pending):
+            if 'entry' not in record:
+                archived.pop((record['project'], record['filename']), None)
+                continue
+            entry = record['entry']
+            key = (record['project'], entry['filename'])
+            archived[key] = max(archived.get(key, 0), entry.get('timestamp') or 0)
+        timestamps = {}
+        for ((_, filename), timestamp) in archived.items():
+            timestamps[filename] = max(timestamps.get(filename, 0), timestamp)
+        for (filename, timestamp) in timestamps.items():
+            index.add(filename, timestamp)
+
+    def __invalidate_index(self):
+        """Drop the search index (and the one being built), it is built again by the next search"""
+        self.__path_index = None
+        self.__index_generation += 1
+
+    def __update_index(self, added=(), removed=()):
+        """Keep the search index (if it was built) up to date with the added and removed entries"""
+        if self.__path_index is None:
+            if self.__index_changes is not None:
+                # Replayed once the index that is being built is ready
+                self.__index_changes.append((list(added), list(removed)))
+            return
+        for entry in added:
+            self.__path_index.add(entry.filename, entry.timestamp)
+        for entry in removed:
+            self.__path_index.remove(entry.filename)
+
+    def get_path_matcher(self, override_settings):
+        """Return the (cached) PathMatcher for the global patterns extended by a project's override_settings"""
+        exclude_overrides = tuple(override_settings.get("path_exclude_patterns", []))
+        reinclude_overrides = tuple(override_settings.get("path_reinclude_patterns", []))
+        cache_key = (exclude_overrides, reinclude_overrides)
+
+        matcher = self.__path_matchers.get(cache_key)
+        if matcher is None:
+            matcher = PathMatcher(self.PATH_EXCLUDE_PATTERNS + list(exclude_overrides),
+                                  self.PATH_REINCLUDE_PATTERNS + list(reinclude_overrides))
+            self.__path_matchers[cache_key] = matcher
+        return matcher
+
+    def resolve_path(self, filename):
+        """Return the file name as it is stored in the history (with the symlinks resolved if `real_path` is set)"""
+        if not self.REAL_PATH:
+            return filename
+        realname = self.real_paths.resolve(filename)
+        if realname != filename:
+            self.debug("Resolved '%s' to '%s'", filename, realname)
+        return realname
+
+    def __is_excluded(self, matcher, filename):
+        if not self.PRINT_DEBUG:
+            return matcher.is_excluded(filename)
+
+        # Report which patterns were responsible
+        (filename, exclude, reinclude) = matcher.explain(filename)
+        if exclude is None:
+            return False
+        self.debug('[X] Exclusion pattern "%s" blocks history tracking for filename "%s"'
+                   % (exclude, filename))
+        if reinclude is not None:
+            self.debug('[O] Inclusion pattern "%s" re-includes history tracking for filename "%s"'
+                       % (reinclude, filename))
+            return False
+        return True
 
-    def __ensure_project(self, project_name):
-        """Make sure the project nodes exist (including 'opened' and 'closed')"""
-        if project_name not in self.history:
-            self.history[project_name] = {}
-            self.history[project_name]['opened'] = []
-            self.history[project_name]['closed'] = []
+    def add_view(self, window, view, history_type):
+        """Add the file of a view to the history (or remove it if it is excluded or doesn't exist).
 
-    def is_suppressed(self, view, filename):
-        override_settings = view.settings().get("file_history", dict())
-        exclude_patterns = self.PATH_EXCLUDE_PATTERNS + override_settings.get("path_exclude_patterns", [])
-        reinclude_patterns = self.PATH_REINCLUDE_PATTERNS + override_settings.get("path_reinclude_patterns", [])
+        Events that arrive in quick succession are collected and added together in the background.
+        """
+        if history_type == 'closed' and view.id() in self.__closed_view_ids:
+            # Already added with its window
+            self.__closed_view_ids.discard(view.id())
+            return
 
-        # Force forward slashes in the filename
-        filename = os.path.normpath(filename).replace("\\", "/")
-
-        # Search the filename for the pattern and suppress it if it matches
-        for exclude in exclude_patterns:
-            if re.search(exclude, filename):
-                self.debug('[X] Exclusion pattern "%s" blocks history tracking for filename "%s"'
-                           % (exclude, filename))
-                # See if none of out reinclude patterns nullifies the exclude
-                for reinclude in reinclude_patterns:
-                    if re.search(reinclude, filename):
-                        self.debug('[O] Inclusion pattern "%s" re-includes history tracking for filename "%s"'
-                                   % (reinclude, filename))
-                        return False
-                return True
+        event = self.__capture_view(window, view, history_type)
+        if event is None:
+            return
 
-        return False
+        now = time.perf_counter()
+        with self.lock:
+            burst = self.__burst_events is not None or now - self.__last_view_event < self.BURST_INTERVAL
+            self.__last_view_event = now
 
-    def add_view(self, window, view, history_type):
-        # No point adding a transient view to the history
-        if self.is_transient_view(window, view):
+        if burst:
+            self.__add_to_burst([event])
+        else:
+            self.__add_events([event])
+
+    def add_views(self, window, views, history_type):
+        """Add the files of multiple views of a window to the history in one go.
+
+        The views are captured right away, but added in the background with the current burst.
+        """
+        events = [self.__capture_view(window, view, history_type) for view in views]
+        self.__add_to_burst([event for event in events if event is not None])
+
+    def close_window(self, window):
+        """Add the files of all views of a closing window to the history in one go.
+
+        The `on_pre_close` events of the views that follow are ignored.
+        """
+        views = window.views()
+        self.__closed_view_ids.update(view.id() for view in views)
+        self.add_views(window, views, 'closed')
+        # The events were captured with the project key, which isn't needed anymore
+        self.__project_keys.pop(window.id(), None)
+
+    def flush_view_events(self):
+        """Add the events of the current burst (if any) to the history right away
+        (or wait until the burst that is already being added is done)"""
+        with self.__apply_lock:
+            with self.lock:
+                events = self.__burst_events
+                self.__burst_events = None
+            if events:
+                self.__add_events(events)
+
+    def __add_to_burst(self, events):
+        """Collect events in the current burst (starting one if necessary), which is added in the background"""
+        if not events:
+            return
+        with self.lock:
+            self.__last_view_event = time.perf_counter()
+            start_burst = self.__burst_events is None
+            if start_burst:
+                self.__burst_events = []
+            self.__burst_events.extend(events)
+
+        if start_burst:
+            self.debug('Collecting a burst of tab events')
+            sublime.set_timeout_async(lambda: self.__end_burst(), int(self.BURST_INTERVAL * 1000))
+
+    def __end_burst(self):
+        remaining = self.__last_view_event + self.BURST_INTERVAL - time.perf_counter()
+        if remaining > 0:
+            # Wait until the events stop coming
+            sublime.set_timeout_async(lambda: self.__end_burst(), int(remaining * 1000) + 1)
             return
+        with self.stats.timed('add burst'):
+            self.flush_view_events()
+
+    def __capture_view(self, window, view, history_type):
+        """Return what `__add_events` needs to know about a view (which might be gone by then), or None to ignore it"""
+        # No point adding a transient view (or a preview kept open for `preview_cache_size`) to the history
+        if self.is_transient_view(window, view) or self.__is_cached_preview(view):
+            return None
 
         filename = view.file_name()
         # Only keep track of files that have a filename
-        if filename is not None:
-            if self.REAL_PATH:
-                realname = os.path.realpath(view.file_name())
-                if realname != filename:
-                    self.debug("Resolved '%s' to '%s'" % (filename, realname))
-                    filename = realname
-
-            project_name = self.get_current_project_key()
-            if self.is_suppressed(view, filename):
-                # If filename matches 'path_exclude_patterns' then abort the history tracking
-                # and remove any references to this file from the history
-                self.__remove(project_name, filename)
-                self.__remove('global', filename)
-            elif os.path.exists(filename):
-                # Add to both the project-specific and global histories
-                (group, index) = sublime.active_window().get_view_index(view)
-                self.__add_to_history(project_name, history_type, filename, group, index)
-                self.__add_to_history('global', history_type, filename, group, index)
-            else:
-                # If the file doesn't exist then remove it from the lists
-                self.__remove(project_name, filename)
-                self.__remove('global', filename)
+        if filename is None:
+            return None
+        filename = self.resolve_path(filename)
 
-            self.__save_history()
+        matcher = self.get_path_matcher(view.settings().get("file_history", dict()))
+        return (self.get_project_key(window), history_type, filename, window.get_view_index(view),
+                int(time.time()), matcher)
 
-    def __add_to_history(self, project_name, history_type, filename, group, index):
-        self.debug('Adding %s file to project "%s" with group %s and index %s: %s' % (history_type, project_name, group, index, filename))
+    def __add_events(self, events):
+        """Apply captured tab events to the history in a single transaction and save it once"""
+        if not events:
+            return
 
+        with self.__apply_lock:
+            # Exclusions are checked once per file and matcher, existence once per file
+            excluded = {}
+            for (_, _, filename, _, _, matcher) in events:
+                if (filename, matcher) not in excluded:
+                    excluded[(filename, matcher)] = self.__is_excluded(matcher, filename)
+            included = set(filename for ((filename, _), is_excluded) in excluded.items() if not is_excluded)
+            existing = self.__check_paths(included)
+
+            # If a file is excluded or doesn't exist, remove it from the history (position None)
+            events = [(project_name, history_type, filename,
+                       position if existing.get(filename) and not excluded[(filename, matcher)] else None, timestamp)
+                      for (project_name, history_type, filename, position, timestamp, matcher) in events]
+
+            with self.lock:
+                if not self.loaded:
+                    # The views might be gone when the history is loaded, so remember what we need now
+                    self.__pending_events.extend(events)
+                    return
+                for event in events:
+                    self.__apply_view_event(*event)
+
+            self.__save_history(journaled=True)
+
+    def __apply_view_event(self, project_name, history_type, filename, position, timestamp):
+        """Add the file to (or remove it from if position is None) the project and global histories"""
+        if position is None:
+            self.__remove(project_name, filename)
+            self.__remove('global', filename)
+        else:
+            # Entries are never modified, so both histories can share the same one
+            (group, index) = position
+            (count, score) = self.__frecency(project_name, history_type, filename, timestamp)
+            entry = HistoryEntry(filename, group, index, timestamp, count, score)
+            self.__add_to_history(project_name, history_type, entry)
+            self.__add_to_history('global', history_type, entry)
+
+    def __frecency(self, project_name, history_type, filename, timestamp):
+        """Return the access count and frecency score of a file that is opened or closed now.
+
+        Opening a file counts as an access, closing it only carries the (decayed) score over.
+        """
+        previous = None
+        for name in (project_name, 'global'):
+            project = self.__get_project(name)
+            if project is not None:
+                previous = project['opened'].get(filename) or project['closed'].get(filename)
+                if previous is not None:
+                    break
+        if previous is None:
+            return (1, 1.0)
+
+        accessed = 1 if history_type == 'opened' else 0
+        return (previous.count + accessed, previous.decayed_score(timestamp) + accessed)
+
+    def __add_to_history(self, project_name, history_type, entry):
+        self.debug('Adding %s file to project "%s" with group %s and index %s: %s',
+                   history_type, project_name, entry.group, entry.index, entry.filename)
+
+        self.__insert_entry(project_name, history_type, entry)
+        if self.__tombstones:
+            # The file was reopened after it was removed
+            self.__tombstones.pop((project_name, entry.filename), None)
+        # Entries are never modified, so it is only serialized if and when the record is written
+        self.__log({'op': 'add', 'project': project_name, 'type': history_type, 'entry': entry})
+
+    def __insert_entry(self, project_name, history_type, entry):
         # Make sure the project nodes exist
-        self.__ensure_project(project_name)
+        project = self.__get_project(project_name, create=True)
 
         # Remove the file from the project list then
         # add it to the top (of the opened/closed list)
-        self.__remove(project_name, filename)
-        entry = {'filename': filename, 'group': group, 'index': index, 'timestamp': int(time.time())}
-        self.history[project_name][history_type].insert(0, entry)
+        entry = HistoryEntry.coerce(entry)
+        self.__discard(project_name, entry.filename)
+        history_list = project[history_type]
+        history_list.add(entry)
 
         # Make sure we limit the number of history entries
-        max_num_entries = self.GLOBAL_MAX_ENTRIES if project_name == 'global' else self.PROJECT_MAX_ENTRIES
-        self.history[project_name][history_type] = self.history[project_name][history_type][0:max_num_entries]
+        evicted = history_list.truncate(self.max_entries(project_name), self.HISTORY_ORDER == 'frecency')
+        self.__update_index([entry])
+        self.__evicted(project_name, history_type, evicted)
 
     def __remove(self, project_name, filename):
+        if self.__discard(project_name, filename):
+            removed_at = self.__add_tombstone(project_name, filename)
+            self.__log({'op': 'remove', 'project': project_name, 'filename': filename, 'time': removed_at})
+
+    def __discard(self, project_name, filename):
+        """Remove any references to this file from the project. Returns whether there were any"""
+        project = self.__get_project(project_name)
         # Only continue if this project exists
-        if project_name not in self.history:
-            return
+        if project is None:
+            return False
 
-        # Remove any references to this file from the project
+        removed = False
         for history_type in ('opened', 'closed'):
-            for node in iter(self.history[project_name][history_type]):
-                if node['filename'] == filename:
-                    self.history[project_name][history_type].remove(node)
+            entry = project[history_type].remove(filename)
+            if entry is not None:
+                self.__update_index(removed=[entry])
+                removed = True
+        return removed
 
     def clean_history(self, current_project_only):
-        if current_project_only:
-            self.__clean_history(self.get_current_project_key())
-        else:
-            # Clean-up the all histories and remove orphaned projects
-            orphan_list = []
-            open_projects = [self.get_project_key(window) for window in sublime.windows()]
-            for project_key in self.history:
+        """Remove non-existent files (and orphaned projects) from the history.
+
+        Projects that aren't loaded yet are only checked for being orphaned;
+        their files are checked once they are loaded (see `__get_project`).
+        Returns a dict with the number of checked paths, removed entries and the elapsed time.
+        """
+        self.ensure_loaded()
+        start_time = time.time()
+        with self.lock:
+            if current_project_only:
+                project_keys = [self.get_current_project_key()]
+                # It's cleaned right away
+                self.__uncleaned_projects.discard(project_keys[0])
+                if self.__get_project(project_keys[0]) is None:
+                    sublime.status_message("This project does not have any history")
+                    return
+            else:
+                project_keys = list(self.history) + list(self.__unloaded_projects)
+                self.__uncleaned_projects.update(self.__unloaded_projects)
+
+        stats = self.__clean_projects(project_keys, compact_archive=not current_project_only)
+        stats['duration'] = time.time() - start_time
+        if self.stats.enabled:
+            self.stats.record('clean history', stats['duration'])
+        self.debug('Cleaned the history: checked %(checked)d paths and removed %(removed)d entries in %(duration).3fs'
+                   % stats)
+        sublime.status_message("File history cleaned (checked %(checked)d files, removed %(removed)d entries)" % stats)
+        return stats
+
+    def __clean_projects(self, project_keys, compact_archive=False):
+        """Remove the non-existent files from the loaded projects and drop the orphaned projects.
+
+        All paths are checked in parallel before the history is modified in one go.
+        With `compact_archive`, the archive (if enabled) is compacted afterwards.
+        Returns a dict with the number of checked paths and removed entries.
+        """
+        open_projects = [self.get_project_key(window) for window in sublime.windows()]
+
+        # Collect every distinct path (the same file is usually tracked in 'global' and its project)
+        paths = set()
+        with self.lock:
+            for project_key in project_keys:
+                if project_key != 'global' and project_key not in open_projects:
+                    paths.add(project_key)
+                project = self.history.get(project_key)
+                if project is not None:
+                    for history_type in ('opened', 'closed'):
+                        paths.update(node['filename'] for node in project[history_type])
+
+        existing = self.__check_paths(paths, self.CLEANUP_TIMEOUT)
+
+        removed = 0
+        with self.lock:
+            for project_key in project_keys:
+                if project_key not in self.history and project_key not in self.__unloaded_projects:
+                    continue
                 # clean the project or remove it (if it no longer exists)
-                if (
-                    project_key == 'global'
-                    or os.path.exists(project_key)
-                    or project_key in open_projects
-                ):
-                    # clean the project
-                    self.__clean_history(project_key)
-                else:
-                    # queue the orphaned project for deletion
-                    orphan_list.append(project_key)
-
-            # remove any orphaned projects and save the history
-            for project_key in orphan_list:
-                self.debug('Removing orphaned project "%s" from the history' % project_key)
-                del self.history[project_key]
+                if not existing.get(project_key, True):
+                    self.debug('Removing orphaned project "%s" from the history' % project_key)
+                    self.__drop_project(project_key)
+                elif project_key in self.history:
+                    removed += self.__clean_history(project_key, existing)
 
         # Save history
         self.__save_history()
-
-    def __clean_history(self, project_name):
+        if compact_archive and self.has_archive():
+            self.__compact_archive(existing)
+        return dict(checked=len(paths), removed=removed)
+
+    def __check_paths(self, paths, timeout=None):
+        """Check which paths exist, using up to `cleanup_workers` threads (see `StatCache.stat_many` for timeout)"""
+        # Don't trust cached results for deleting entries, but refresh the cache while we're at it
+        # (files on unavailable mounts or that weren't checked in time are kept)
+        results = self.stat_cache.stat_many(paths, refresh=True, timeout=timeout)
+        return {path: result is not None for (path, result) in results.items()}
+
+    def __clean_history(self, project_name, existing):
+        """Remove the files that don't exist according to `existing` from the project"""
         self.debug('Cleaning the "%s" history' % (project_name))
-        # Only continue if this project exists
-        if project_name not in self.history:
-            sublime.status_message("This project does not have any history")
-            return
-
-        # Remove any non-existent files from the project
+        removed = 0
         for history_type in ('opened', 'closed'):
-            for node in reversed(self.history[project_name][history_type]):
-                if not os.path.exists(node['filename']):
-                    self.debug('Removing non-existent file from project "%s": %s' % (project_name, node['filename']))
-                    self.history[project_name][history_type].remove(node)
-
-        sublime.status_message("File history cleaned")
+            for node in self.history[project_name][history_type].to_list():
+                # Files added since the check are assumed to exist
+                if not existing.get(node['filename'], True):
+                    self.debug('Removing non-existent file from project "%s": %s', project_name, node['filename'])
+                    self.__remove(project_name, node['filename'])
+                    removed += 1
+        return removed
 
     def __clear_context(self):
         """Reset the calling view variables"""
@@ -459,18 +3078,101 @@ class FileHistory(metaclass=Singleton):
             return
 
         filepath = history_entry['filename']
-        if os.path.exists(filepath):
-            # asynchronously open the preview (improves perceived performance)
-            sublime.set_timeout_async(lambda: self.__open_preview(window, filepath), 0)
-        else:
+
+        # Supersede the preview that is still waiting for the delay (if any)
+        self.__preview_request += 1
+        request = self.__preview_request
+
+        result = self.stat_cache.stat(filepath)
+        if result is StatCache.UNAVAILABLE:
+            # Don't wait for (or remove) files on mounts that aren't responding
+            self.__close_preview(window)
+            sublime.status_message('"%s" is unavailable' % filepath)
+        elif result is None:
             # Close the last preview and remove the non-existent file from the history
             self.__close_preview(window)
-            self.__remove(self.get_current_project_key(), filepath)
-            self.__save_history()
+            project_key = self.get_current_project_key()
+            with self.lock:
+                self.__remove(project_key, filepath)
+            self.__save_history(journaled=True)
+        elif self.PREVIEW_MAX_SIZE and result.st_size > self.PREVIEW_MAX_SIZE:
+            self.__close_preview(window)
+            sublime.status_message('"%s" is too large to preview' % filepath)
+        else:
+            # Asynchronously open the preview once the user stops scrolling through the panel
+            # (a preview that is still open from moving back and forth is shown right away)
+            delay = 0 if filepath in self.__preview_views else self.PREVIEW_DELAY
+            sublime.set_timeout_async(lambda: self.__open_preview(window, filepath, request), delay)
+
+    def __open_preview(self, window, filepath, request):
+        if request != self.__preview_request:
+            # Another entry was highlighted (or the panel was closed) in the meantime
+            self.debug("Skipping superseded preview for '%s'", filepath)
+            return
 
-    def __open_preview(self, window, filepath):
-        self.debug("Opening preview for '%s'" % filepath)
-        self.current_view = window.open_file(filepath, sublime.TRANSIENT | getattr(sublime, 'FORCE_GROUP', 0))
+        self.debug("Opening preview for '%s'", filepath)
+        with self.stats.timed('open preview'):
+            if self.PREVIEW_CACHE_SIZE > 0:
+                self.current_view = self.__open_cached_preview(window, filepath)
+            else:
+                self.current_view = window.open_file(filepath, sublime.TRANSIENT | getattr(sublime, 'FORCE_GROUP', 0))
+
+    def __open_cached_preview(self, window, filepath):
+        """Preview the file in a regular tab, which is kept open (and reused) until the panel is closed
+        or the `preview_cache_size` most recent previews no longer include it"""
+        view = self.__preview_views.pop(filepath, None)
+        if view is not None and view.window() is not None:
+            window.focus_view(view)
+        else:
+            existing_view = window.find_open_file(filepath)
+            if existing_view is not None and window.get_view_index(existing_view)[0] == window.active_group():
+                # The file was already open, so it isn't ours to close
+                window.focus_view(existing_view)
+                return existing_view
+            # on_load might be called before open_file returns
+            self.__opening_previews.add(filepath)
+            try:
+                view = window.open_file(filepath, getattr(sublime, 'FORCE_GROUP', 0))
+                self.__preview_view_ids.add(view.id())
+            finally:
+                self.__opening_previews.discard(filepath)
+
+        self.__preview_views[filepath] = view
+        if len(self.__preview_views) > self.PREVIEW_CACHE_SIZE:
+            while len(self.__preview_views) > self.PREVIEW_CACHE_SIZE:
+                self.__close_view(window, self.__preview_views.popitem(last=False)[1])
+            window.focus_view(view)
+        return view
+
+    def __close_cached_previews(self, window, keep=None):
+        """Close the previews kept open for `preview_cache_size`, except the one of the file `keep` (which is returned)"""
+        kept_view = self.__preview_views.pop(keep, None)
+        while self.__preview_views:
+            self.__close_view(window, self.__preview_views.popitem(last=False)[1])
+        return kept_view
+
+    def __keep_cached_preview(self, window, view):
+        """The user opened a cached preview, so it is a regular view from now on"""
+        self.__preview_view_ids.discard(view.id())
+        self.add_view(window, view, 'opened')
+
+    def __is_cached_preview(self, view):
+        return view.id() in self.__preview_view_ids or view.file_name() in self.__opening_previews
+
+    def forget_view(self, view):
+        """Called when a view is closed (after it was added to the history)"""
+        self.__preview_view_ids.discard(view.id())
+
+    @staticmethod
+    def __close_view(window, view):
+        if view.window() is None:
+            # Already closed by the user
+            return
+        elif hasattr(view, 'close'):
+            view.close()
+        else:
+            window.focus_view(view)
+            window.run_command("close_file")
 
     def quick_open_preview(self, window):
         """Open the file that is currently being previewed
@@ -478,11 +3180,23 @@ class FileHistory(metaclass=Singleton):
         if not self.current_history_entry:
             return
 
-        view = self.current_view
-        other_view = self.get_view_from_another_group(window, view.file_name())
+        # The file is opened right away if its preview is still waiting for the delay
+        self.__preview_request += 1
 
-        # Only try to open and position the file if it is transient
-        if self.is_transient_view(window, view):
+        filename = self.current_history_entry['filename']
+        if self.stat_cache.is_unavailable(filename):
+            sublime.status_message('"%s" is unavailable' % filename)
+            return
+        view = self.current_view
+        if view is not None and self.__preview_views.get(filename) == view:
+            # Keep the preview open and move it to the position of the history entry
+            del self.__preview_views[filename]
+            (group, index) = self.__calculate_view_index(window, self.current_history_entry)
+            window.set_view_index(view, group, index)
+            self.__keep_cached_preview(window, view)
+        elif self.is_transient_view(window, view):
+            # Only try to open and position the file if it is transient
+            other_view = self.get_view_from_another_group(window, filename)
             if not self.REOPEN_IN_CURRENT_GROUP and other_view:
                 # Focus the other view instead of opening a clone
                 self.debug("Focussing existing view in group %d" % window.get_view_index(other_view)[0])
@@ -492,7 +3206,7 @@ class FileHistory(metaclass=Singleton):
                 return True
             else:
                 (group, index) = self.__calculate_view_index(window, self.current_history_entry)
-                view = window.open_file(self.current_history_entry['filename'])
+                view = window.open_file(filename)
                 window.set_view_index(view, group, index)
 
         # Refocus on the newly opened file rather than the original one
@@ -506,13 +3220,22 @@ class FileHistory(metaclass=Singleton):
 
         filename = self.current_history_entry['filename']
         self.debug('Removing history entry for "%s" from project "%s"' % (filename, self.project_name))
-        self.__remove(self.project_name, filename)
-        self.__save_history()
+        with self.lock:
+            self.__remove(self.project_name, filename)
+            if self.ARCHIVE_EVICTED:
+                # The entry might have been loaded from the archive, hide its archived records as well
+                self.__archive_pending.append({'op': 'remove', 'project': self.project_name, 'filename': filename})
+                self.__invalidate_index()
+        self.__save_history(journaled=True)
 
     def open_history(self, window, history_entry):
         """Open the file represented by the history_entry in the provided window"""
         self.__track_calling_view(window)
 
+        # Cancel the waiting preview and close the other previews that were kept open
+        self.__preview_request += 1
+        kept_view = self.__close_cached_previews(window, keep=history_entry['filename'])
+
         (group, index) = self.__calculate_view_index(window, history_entry)
 
         if not self.REOPEN_IN_CURRENT_GROUP or not hasattr(sublime, 'FORCE_GROUP'):
@@ -526,6 +3249,8 @@ class FileHistory(metaclass=Singleton):
             window.open_file(history_entry['filename'], sublime.FORCE_GROUP)
             self.debug('Opened clone of file in current group: %s' % history_entry['filename'])
 
+        if kept_view is not None:
+            self.__keep_cached_preview(window, kept_view)
         self.__clear_context()
 
     def __close_preview(self, window):
@@ -538,6 +3263,12 @@ class FileHistory(metaclass=Singleton):
         elif self.current_view.id() != active_view.id():
             self.debug("ID mismatch!")
             return
+        elif self.current_view in self.__preview_views.values():
+            # Keep the preview open for `preview_cache_size`, but show the calling view again
+            if self.calling_view is not None:
+                window.focus_view(self.calling_view)
+            self.current_view = None
+            return
         elif not self.is_transient_view(window, self.current_view):
             self.debug("Last 'opened' view not transient")
             return
@@ -548,7 +3279,12 @@ class FileHistory(metaclass=Singleton):
 
     def reset(self, window):
         """The user cancelled the action - give the focus back to the "calling" view and clear the context"""
+        self.__preview_request += 1
         self.__close_preview(window)
+        if self.__preview_views:
+            self.__close_cached_previews(window)
+            if self.calling_view is not None and self.calling_view.window() is not None:
+                window.focus_view(self.calling_view)
         self.__clear_context()
 
     def is_transient_view(self, window, view):
@@ -560,8 +3296,7 @@ class FileHistory(metaclass=Singleton):
             # If the view index is -1, then this can't be a real view.
             # window.transient_view_in_group is not returning the correct
             # value when we quickly cycle through the quick panel previews.
-            self.debug("Detected possibly transient view with index = -1: '%s'"
-                       % view.file_name())
+            self.debug("Detected possibly transient view with index = -1: '%s'", view.file_name())
             return True
         else:
             return view == window.transient_view_in_group(window.active_group())
@@ -573,13 +3308,17 @@ class FileHistory(metaclass=Singleton):
         else:
             calling_group = window.get_view_index(window.active_view())[0]
 
-        # Scan for view with same file_name in other groups
-        for group in range(window.num_groups()):
-            if group == calling_group:
+        # Find a view with the same file_name in the lowest other group
+        other_view = None
+        other_group = None
+        for view in self.open_views.find(window, filename):
+            (group, index) = window.get_view_index(view)
+            if index < 0 or view == window.transient_view_in_group(group):
+                # Previews don't count
                 continue
-            for view in window.views_in_group(group):
-                if view.file_name() == filename:
-                    return view
+            if group != calling_group and (other_group is None or group < other_group):
+                (other_view, other_group) = (view, group)
+        return other_view
 
 #######################################
 
@@ -588,10 +3327,46 @@ class OpenRecentlyClosedFileEvent(sublime_plugin.EventListener):
     # We need pre close to detect if the view was transient,
     # otherwise it always has (-1, -1) group and index.
     def on_pre_close(self, view):
-        FileHistory().add_view(sublime.active_window(), view, 'closed')
+        with FileHistory().stats.timed('on_pre_close'):
+            FileHistory().add_view(sublime.active_window(), view, 'closed')
+            FileHistory().open_views.remove(view)
+            FileHistory().forget_view(view)
 
     def on_load(self, view):
-        FileHistory().add_view(sublime.active_window(), view, 'opened')
+        with FileHistory().stats.timed('on_load'):
+            FileHistory().add_view(sublime.active_window(), view, 'opened')
+            FileHistory().open_views.add(view)
+
+    # Keep the index of open views up to date (views are verified when looked up, so missing an event is harmless)
+    def on_clone(self, view):
+        FileHistory().open_views.add(view)
+
+    def on_post_save(self, view):
+        # The file might have been saved under another name
+        FileHistory().open_views.add(view)
+
+    def on_post_move(self, view):
+        FileHistory().open_views.add(view)
+
+    def on_pre_close_window(self, window):
+        with FileHistory().stats.timed('on_pre_close_window'):
+            FileHistory().close_window(window)
+            FileHistory().open_views.discard_window(window)
+
+    # The project key is cached per window, so check for changes to the project
+    def on_activated(self, view):
+        window = view.window()
+        if window:
+            with FileHistory().stats.timed('on_activated'):
+                FileHistory().refresh_project_key(window)
+
+    def on_load_project(self, window):
+        with FileHistory().stats.timed('on_load_project'):
+            FileHistory().refresh_project_key(window)
+
+    def on_post_save_project(self, window):
+        with FileHistory().stats.timed('on_post_save_project'):
+            FileHistory().refresh_project_key(window)
 
 
 class CleanupFileHistoryCommand(sublime_plugin.WindowCommand):
@@ -604,17 +3379,124 @@ class ResetFileHistoryCommand(sublime_plugin.WindowCommand):
         FileHistory().delete_all_history()
 
 
+class RestoreFileHistoryCommand(sublime_plugin.WindowCommand):
+    """List the backups of the history (with their size and number of entries) and restore the selected one"""
+
+    def run(self):
+        # Reading every backup can be slow (e.g. on a network share), so list them in the background
+        sublime.set_timeout_async(lambda: self.list_backups(), 0)
+
+    def list_backups(self):
+        backups = FileHistory().list_backups()
+        if not backups:
+            sublime.status_message("There are no backups of the file history")
+            return
+
+        items = []
+        for backup in backups:
+            try:
+                size = os.path.getsize(backup)
+                history = FileHistory().read_backup(backup)
+                history.pop(FileHistory.SCHEMA_VERSION_KEY, None)
+                history.pop(FileHistory.TOMBSTONES_KEY, None)
+                global_history = history.get('global', {})
+                entries = len(global_history.get('opened', [])) + len(global_history.get('closed', []))
+                details = '%.1f KB, %d entries in %d projects' % (size / 1024, entries,
+                                                                  len(history) - ('global' in history))
+            except Exception as e:
+                details = 'could not be read (%s)' % e.__class__.__name__
+            items.append([os.path.basename(backup), details])
+
+        sublime.set_timeout(lambda: self.show_backups(backups, items), 0)
+
+    def show_backups(self, backups, items):
+        self.backups = backups
+        self.window.show_quick_panel(items, self.on_done)
+
+    def on_done(self, index):
+        if index < 0:
+            return
+        backup = self.backups[index]
+        sublime.set_timeout_async(lambda: FileHistory().restore_backup(backup), 0)
+
+
+class ShowFileHistoryStatsCommand(sublime_plugin.WindowCommand):
+    """Show the collected performance stats in an output panel"""
+
+    PANEL_NAME = 'file_history_stats'
+
+    def run(self, reset=False):
+        history = FileHistory()
+        if not history.stats.enabled:
+            sublime.status_message('Enable the "performance_stats" setting to collect performance stats')
+            return
+
+        text = '%s\n\nSaves requested: %d, written: %d\n' % (history.stats.report(), history.save_requests, history.save_writes)
+        panel = self.window.create_output_panel(self.PANEL_NAME)
+        panel.run_command('append', {'characters': text})
+        self.window.run_command('show_panel', {'panel': 'output.' + self.PANEL_NAME})
+
+        if reset:
+            history.stats.reset()
+
+
+class SearchFileHistoryCommand(sublime_plugin.WindowCommand):
+    """Search the history of all projects by path segments and open the selected file"""
+
+    MAX_RESULTS = 500
+
+    def run(self, query=None):
+        if query is None:
+            # Build the index while the query is being typed
+            sublime.set_timeout_async(lambda: FileHistory().prepare_search(), 0)
+            self.window.show_input_panel('Search file history:', '', lambda query: self.run(query), None, None)
+            return
+
+        # The index might still be being built, so search on the async thread
+        sublime.set_timeout_async(lambda: self.search(query), 0)
+
+    def search(self, query):
+        with FileHistory().stats.timed('search history'):
+            results = FileHistory().search_history(query, self.MAX_RESULTS)
+        sublime.set_timeout(lambda: self.show_results(query, results), 0)
+
+    def show_results(self, query, results):
+        self.results = results
+        if not self.results:
+            sublime.status_message('No files in the history match "%s"' % query)
+            return
+
+        items = [[os.path.basename(filename), os.path.dirname(filename)] for filename in self.results]
+        font_flag = sublime.MONOSPACE_FONT if FileHistory().USE_MONOSPACE else 0
+        self.window.show_quick_panel(items, self.on_done, font_flag)
+
+    def on_done(self, index):
+        if index < 0:
+            return
+        filename = self.results[index]
+        if FileHistory().stat_cache.is_unavailable(filename):
+            sublime.status_message('"%s" is unavailable' % filename)
+        elif FileHistory().stat_cache.exists(filename):
+            self.window.open_file(filename)
+        else:
+            sublime.status_message('"%s" no longer exists' % filename)
+
+
 class OpenRecentlyClosedFileCommand(sublime_plugin.WindowCommand):
     """class to either open the last closed file or show a quick panel with the recent file history (closed files first)"""
 
     __is_active = False
 
-    def approximate_age(self, from_stamp, to_stamp=None, precision=2):
-        """Calculate the relative time from given timestamp to another given (epoch) or now."""
-        if to_stamp is None:
-            to_stamp = time.time()
-        rem = to_stamp - from_stamp
+    # Rendered panel rows per project, see `build_display_list`
+    __display_cache = {}
 
+    MAGNITUDES = ("years", "months", "weeks", "days", "hours", "minutes", "seconds")
+    # The smallest number of seconds after which a magnitude's value can change
+    # (years, months and weeks are derived from the number of days)
+    MAGNITUDE_GRANULARITY = (86400, 86400, 86400, 86400, 3600, 60, 1)
+
+    def age_magnitudes(self, rem):
+        """Split a number of seconds into the values of MAGNITUDES"""
         def divide(rem, mod):
             return rem % mod, int(rem // mod)
 
@@ -629,14 +3511,20 @@ class OpenRecentlyClosedFileCommand(sublime_plugin.WindowCommand):
         months, days = subtract(days, 30)
         weeks,  days = subtract(days, 7)
 
+        values = locals()
+        return [int(values[magnitude]) for magnitude in self.MAGNITUDES]
+
+    def approximate_age(self, from_stamp, to_stamp=None, precision=2):
+        """Calculate the relative time from given timestamp to another given (epoch) or now."""
+        if to_stamp is None:
+            to_stamp = time.time()
+
         magnitudes = []
         first = None
-        values = locals()
-        for i, magnitude in enumerate(("years", "months", "weeks", "days", "hours", "minutes", "seconds")):
-            v = int(values[magnitude])
+        for i, v in enumerate(self.age_magnitudes(to_stamp - from_stamp)):
             if v == 0:
                 continue
-            s = "%s %s" % (v, magnitude)
+            s = "%s %s" % (v, self.MAGNITUDES[i])
             if v == 1:  # strip plural s
                 s = s[:-1]
             # Handle precision limit
@@ -648,6 +3536,143 @@ class OpenRecentlyClosedFileCommand(sublime_plugin.WindowCommand):
 
         return ", ".join(magnitudes)
 
+    def approximate_age_expiry(self, from_stamp, to_stamp=None, precision=2):
+        """Calculate the time at which the result of `approximate_age` will change."""
+        if to_stamp is None:
+            to_stamp = time.time()
+        rem = to_stamp - from_stamp
+
+        values = self.age_magnitudes(rem)
+        first = next((i for i, v in enumerate(values) if v), len(values) - 1)
+        granularity = self.MAGNITUDE_GRANULARITY[min(first + precision - 1, len(values) - 1)]
+        return from_stamp + (rem // granularity + 1) * granularity
+
+    def render_entry(self, entry, key, now, result):
+        """Render the panel row for a history entry and return it with the time its text stays valid until.
+
+        `result` is the (prefetched) stat result of the file, see `StatCache.stat`.
+        """
+        filepath = entry['filename']
+        info = [os.path.basename(filepath), os.path.dirname(filepath)]
+        expires = float('inf')
+
+        # Only include the timestamp if it is there and if the user wants to see it
+        if FileHistory().TIMESTAMP_SHOW:
+            if result is None:
+                stamp = 'file no longer exists'
+            elif result is StatCache.UNAVAILABLE:
+                stamp = 'unavailable'
+            else:
+                (action, timestamp) = FileHistory().get_history_timestamp(entry, key, result)
+                if not timestamp:
+                    stamp = ''
+                elif bool(FileHistory().TIMESTAMP_RELATIVE):
+                    stamp = '%s %s ago' % (action, self.approximate_age(timestamp, now))
+                    expires = self.approximate_age_expiry(timestamp, now)
+                else:
+                    stamp_str = time.strftime(FileHistory().TIMESTAMP_FORMAT, time.gmtime(timestamp))
+                    stamp = '%s at %s' % (action, stamp_str)
+            info.append((' ' * 6) + stamp)
+
+        return info, expires
+
+    @staticmethod
+    def row_state(entry, result):
+        """What a row depends on besides its entry: whether the file exists (and its mtime, if that is displayed)"""
+        if result is None or result is StatCache.UNAVAILABLE:
+            return result
+        elif FileHistory().TIMESTAMP_MODE != 'history_access' or 'timestamp' not in entry:
+            return result.st_mtime
+        return True
+
+    def build_display_list(self, project_name, history):
+        """Prepare the display list with the file name and path separated.
+
+        Rows are cached per project and only rendered again if their entry changed,
+        the file was removed (or became unavailable) or the displayed relative age would be different.
+        Whether the files exist is checked again (in parallel) once the stat cache would.
+        The returned list is shared with the cache and must not be modified.
+        """
+        now = time.time()
+        settings = (FileHistory().TIMESTAMP_SHOW, FileHistory().TIMESTAMP_RELATIVE,
+                    FileHistory().TIMESTAMP_FORMAT, FileHistory().TIMESTAMP_MODE, FileHistory().HISTORY_ORDER)
+        version = history.version
+
+        cached = self.__display_cache.get(project_name)
+        if cached and cached['settings'] == settings:
+            if version is not None and cached['version'] == version and now < cached['expires']:
+                return cached['display_list']
+            row_cache = cached['rows']
+        else:
+            row_cache = {}
+
+        stats = {}
+        if FileHistory().TIMESTAMP_SHOW:
+            stats = FileHistory().stat_cache.stat_many([entry['filename'] for key in ('closed', 'opened')
+                                                        for entry in getattr(history, key)])
+
+        display_list = []
+        rows = {}
+        expires = float('inf')
+        for key in ('closed', 'opened'):
+            for entry in getattr(history, key):
+                result = stats.get(entry['filename'])
+                row_key = (key, entry['filename'], entry.get('timestamp'), self.row_state(entry, result))
+                row = row_cache.get(row_key)
+                if row is None or row[1] <= now:
+                    row = self.render_entry(entry, key, now, result)
+                rows[row_key] = row
+                display_list.append(row[0])
+                expires = min(expires, row[1])
+        if FileHistory().TIMESTAMP_SHOW:
+            # The stat results expire (counted from the end of the build, which can take a while)
+            expires = min(expires, time.time() + FileHistory().STAT_CACHE_TTL)
+
+        self.__display_cache[project_name] = dict(settings=settings, version=version, expires=expires,
+                                                  rows=rows, display_list=display_list)
+        return display_list
+
+    def load_row(self):
+        """The panel row that loads older entries from the archive, as long as the other rows"""
+        row = ['Load older entries…', 'from the archive of evicted history entries']
+        if FileHistory().TIMESTAMP_SHOW:
+            row.append('')
+        return row
+
+    def load_archive_page(self, selected_index):
+        """Read the next page of archived entries in the background and reopen the panel with them
+        instead of the "load older entries" row (and a new such row) at `selected_index`"""
+        if self.archive_seen is None:
+            self.archive_seen = set(entry.filename for entry in self.entries)
+        entries = self.entries
+        sublime.status_message("[File History] Loading older entries…")
+        sublime.set_timeout_async(lambda: self.read_archive_page(entries, selected_index), 0)
+
+    def read_archive_page(self, entries, selected_index):
+        with FileHistory().stats.timed('load archive page'):
+            (page, cursor) = FileHistory().read_archive(self.project_name, self.archive_cursor, self.archive_seen)
+            now = time.time()
+            stats = {}
+            if FileHistory().TIMESTAMP_SHOW:
+                stats = FileHistory().stat_cache.stat_many([entry.filename for (_, entry) in page])
+            rows = [self.render_entry(entry, history_type, now, stats.get(entry.filename))[0]
+                    for (history_type, entry) in page]
+        sublime.set_timeout(lambda: self.show_archive_page(entries, page, rows, cursor, selected_index), 0)
+
+    def show_archive_page(self, entries, page, rows, cursor, selected_index):
+        if self.entries is not entries:
+            # The panel was opened again meanwhile
+            return
+        self.entries += tuple(entry for (_, entry) in page)
+        self.display_list = self.display_list[:-1] + rows
+        self.archive_cursor = cursor
+        self.archive_more = cursor is not None
+        if self.archive_more:
+            self.display_list.append(self.load_row())
+        self.current_selected_index = selected_index
+        self.set_refresh_in_progress()
+        self.window.run_command('open_recently_closed_file', {'current_project_only': self.current_project_only})
+
     def set_refresh_in_progress(self):
         self.refresh_in_progress = True
 
@@ -661,35 +3686,34 @@ class OpenRecentlyClosedFileCommand(sublime_plugin.WindowCommand):
         if not self.current_selected_index or self.current_selected_index < 0:
             return
 
-        closed_len = len(self.history_list['closed'])
-        if self.current_selected_index < closed_len:
-            key = 'closed'
-        else:
-            self.current_selected_index -= closed_len
-            key = 'opened'
-
-        if self.current_selected_index <= len(self.history_list[key]):
-            del self.history_list[key][self.current_selected_index]
+        # Splice the row out of (copies of) the shared lists, so the panel can be reopened without rebuilding them
+        index = self.current_selected_index
+        self.display_list = self.display_list[:index] + self.display_list[index + 1:]
+        self.entries = self.entries[:index] + self.entries[index + 1:]
 
     def get_history_by_index(self, index):
-        if index < 0:
-            return
-        closed_len = len(self.history_list['closed'])
-        if index < closed_len:
-            key = 'closed'
-        else:
-            index -= closed_len
-            key = 'opened'
+        if 0 <= index < len(self.entries):
+            return self.entries[index]
 
-        if index <= len(self.history_list[key]):
-            return self.history_list[key][index]
+    def is_load_row(self, index):
+        return self.archive_more and index == len(self.display_list) - 1
 
     def run(self, current_project_only=True, action="show_history"):
         if action == "show_history":
             self.current_project_only = current_project_only
 
             if not self.is_refresh_in_progress():
-                self.history_list = FileHistory().get_history(current_project_only)
+                with FileHistory().stats.timed('build panel'):
+                    history = FileHistory().get_history(current_project_only)
+                    self.entries = history.entries
+                    self.display_list = self.build_display_list(FileHistory().project_name, history)
+                    # Older entries are only read from the archive on request
+                    self.project_name = FileHistory().project_name
+                    self.archive_seen = None
+                    self.archive_cursor = None
+                    self.archive_more = FileHistory().has_archive()
+                    if self.archive_more:
+                        self.display_list = self.display_list + [self.load_row()]
                 self.current_selected_index = None
                 self.group_index = self.window.active_group()
                 selected_index = 0
@@ -700,30 +3724,7 @@ class OpenRecentlyClosedFileCommand(sublime_plugin.WindowCommand):
                 selected_index = self.current_selected_index
                 # TODO recover filter text?
 
-            # Prepare the display list with the file name and path separated
-            display_list = []
-            for key in ('closed', 'opened'):
-                for entry in self.history_list[key]:
-                    filepath = entry['filename']
-                    info = [os.path.basename(filepath), os.path.dirname(filepath)]
-
-                    # Only include the timestamp if it is there and if the user wants to see it
-                    if FileHistory().TIMESTAMP_SHOW:
-                        if not os.path.exists(filepath):
-                            stamp = 'file no longer exists'
-                        else:
-                            (action, timestamp) = FileHistory().get_history_timestamp(entry, key)
-                            if not timestamp:
-                                stamp = ''
-                            elif bool(FileHistory().TIMESTAMP_RELATIVE):
-                                stamp = '%s %s ago' % (action, self.approximate_age(timestamp))
-                            else:
-                                stamp_str = time.strftime(FileHistory().TIMESTAMP_FORMAT, time.gmtime(timestamp))
-                                stamp = '%s at %s' % (action, stamp_str)
-                        info.append((' ' * 6) + stamp)
-
-                    display_list.append(info)
-
+            display_list = self.display_list
             if not display_list:
                 return
 
@@ -738,9 +3739,12 @@ class OpenRecentlyClosedFileCommand(sublime_plugin.WindowCommand):
                                    "selected entry with `right` and `ctrl/cmd+del` respectively.")
 
         elif action == "open_latest_closed":
-            self.history_list = FileHistory().get_history(current_project_only)
+            self.entries = FileHistory().get_history(current_project_only, order='recent').entries
+            self.archive_more = False
             self.open_file(0)
         elif action == "delete_current_entry":
+            if self.current_selected_index is not None and self.is_load_row(self.current_selected_index):
+                return
             FileHistory().delete_current_entry()
             if not self.current_selected_index:
                 return
@@ -771,13 +3775,23 @@ class OpenRecentlyClosedFileCommand(sublime_plugin.WindowCommand):
             # for a file that is already open in a different group, so simply don't display the preview for these files.
             # In later releases, a 'FORCE_GROUP' flag has been introduced.
             if hasattr(sublime, 'FORCE_GROUP') or not FileHistory().get_view_from_another_group(self.window, selected_entry['filename']):
-                FileHistory().preview_history(self.window, selected_entry)
+                with FileHistory().stats.timed('preview'):
+                    FileHistory().preview_history(self.window, selected_entry)
 
     def open_file(self, selected_index):
         self.__class__.__is_active = False
 
+        if selected_index >= 0 and self.is_load_row(selected_index):
+            # Reopen the panel with the next page of archived entries at the selection
+            self.load_archive_page(selected_index)
+            return
+
         selected_entry = self.get_history_by_index(selected_index)
-        if selected_entry:
+        if selected_entry and FileHistory().stat_cache.is_unavailable(selected_entry['filename']):
+            # Opening the file would block on the mount that isn't responding
+            FileHistory().reset(self.window)
+            sublime.status_message('"%s" is unavailable' % selected_entry['filename'])
+        elif selected_entry:
             # If the file is open in another group then simply give focus to that view, otherwise open the file
             open_view = FileHistory().get_view_from_another_group(self.window, selected_entry['filename'])
 
@@ -796,7 +3810,8 @@ class OpenRecentlyClosedFileCommand(sublime_plugin.WindowCommand):
                 self.window.run_command('open_recently_closed_file', {'current_project_only': self.current_project_only})
                 return
 
-        self.history_list = {}
+        self.entries = ()
+        self.display_list = []
 
 
 class OpenRecentlyCloseFileCommandContextHandler(sublime_plugin.EventListener):
@@ -824,3 +3839,8 @@ def plugin_loaded():
 def plugin_unloaded():
     # Unregister our on_change callback
     FileHistory().app_settings.clear_on_change(FileHistory.SETTINGS_CALLBACK_KEY)
+    # Make sure pending changes are not lost
+    FileHistory().flush_view_events()
+    FileHistory().flush_history()
+    if FileHistory().storage is not None:
+        FileHistory().storage.close()